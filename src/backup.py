@@ -0,0 +1,388 @@
+#
+# backup.py
+#
+# Copyright (C) 2021 Till Harbaum <till@harbaum.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51 Franklin
+# Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from PyQt5.QtCore import *
+
+import os, time, struct, threading, tempfile
+import hashlib, zipfile
+
+from board import Board
+
+# the SHA-1 of each file is stored in the comment of its zip entry, so
+# later backups don't have to hash the archive again
+DIGEST_PREFIX = b"sha1:"
+
+def entry_digest(zip, info):
+   """ return the SHA-1 of an archive entry, preferably from its comment """
+   if info.comment.startswith(DIGEST_PREFIX):
+      try:
+         return bytes.fromhex(info.comment[len(DIGEST_PREFIX):].decode("ascii"))
+      except ValueError:
+         pass
+
+   # archives written by older versions don't have digests
+   digest = hashlib.sha1()
+   with zip.open(info, 'r') as f:
+      data = f.read(65536)
+      while data:
+         digest.update(data)
+         data = f.read(65536)
+   return digest.digest()
+
+def copy_entry(src, dst, info, comment):
+   """ copy an entry from one archive into another without decompressing
+   and recompressing it. zipfile has no api for this, so the local file
+   header is written directly and the entry is registered with dst the
+   same way zipfile does when closing a regularly written entry """
+   src.fp.seek(info.header_offset)
+   header = src.fp.read(zipfile.sizeFileHeader)
+   if header[0:4] != zipfile.stringFileHeader:
+      raise zipfile.BadZipFile("Bad local file header for " + info.filename)
+   name_len, extra_len = struct.unpack("<HH", header[26:30])
+   src.fp.seek(name_len + extra_len, 1)
+
+   zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+   zinfo.compress_type = info.compress_type
+   zinfo.external_attr = info.external_attr
+   zinfo.CRC = info.CRC
+   zinfo.compress_size = info.compress_size
+   zinfo.file_size = info.file_size
+   zinfo.comment = comment
+   zinfo.header_offset = dst.start_dir
+
+   dst.fp.seek(dst.start_dir)
+   dst.fp.write(zinfo.FileHeader())
+   remaining = info.compress_size
+   while remaining:
+      data = src.fp.read(min(remaining, 65536))
+      if not data:
+         raise zipfile.BadZipFile("Truncated data for " + info.filename)
+      dst.fp.write(data)
+      remaining -= len(data)
+
+   dst.start_dir = dst.fp.tell()
+   dst.filelist.append(zinfo)
+   dst.NameToInfo[zinfo.filename] = zinfo
+   dst._didModify = True
+
+class BackupEntry(object):
+   # a file object the board's worker thread writes a file into while
+   # it's being read. The data goes straight into the archive
+   def __init__(self, backup, name):
+      self.backup = backup
+      self.digest = hashlib.sha1()
+      self.info = zipfile.ZipInfo(name, time.localtime()[:6])
+      with backup.lock:
+         if backup.zip is None:
+            self.fp = None    # backup has been aborted, discard everything
+         else:
+            self.info.compress_type = backup.zip.compression
+            self.fp = backup.zip.open(self.info, 'w')
+            backup.entry = self
+
+   def write(self, data):
+      with self.backup.lock:
+         if self.fp:
+            self.digest.update(data)
+            self.fp.write(data)
+
+   def close(self):
+      with self.backup.lock:
+         if self.fp:
+            self.info.comment = DIGEST_PREFIX + self.digest.hexdigest().encode("ascii")
+            self.fp.close()
+            self.fp = None
+            self.backup.entry = None
+
+class Backup(QObject):
+   """ Backup all files of the board into a zip archive. Files are streamed
+   from the board into the archive, files unchanged since a previous backup
+   into the same archive are copied over from there """
+
+   message = pyqtSignal(str, str)   # status bar and console message
+   done = pyqtSignal(bool, str)     # success and error message
+
+   def __init__(self, board, fname, parent=None):
+      super().__init__(parent)
+      self.board = board
+      self.fname = fname
+      self.old = None
+      self.zip = None
+      self.entry = None
+      self.removed = [ ]
+      self.futures = [ ]
+      # the archive is written from the board's worker thread
+      self.lock = threading.Lock()
+
+   def cmd(self, cmd, cb, parms=None):
+      # on failure only the commands queued here are cancelled
+      self.futures.append(self.board.cmd(cmd, cb, parms))
+
+   def start(self, files):
+      # files is a list of ( path, size ) of all files on the board
+      self.files = files
+
+      try:
+         # an existing archive allows to skip unmodified files
+         try:
+            self.old = zipfile.ZipFile(self.fname, 'r')
+         except Exception:
+            self.old = None
+
+         # the new archive replaces the old one once it's complete
+         fd, self.tmpname = tempfile.mkstemp(suffix=".zip", dir=os.path.dirname(os.path.abspath(self.fname)))
+         os.close(fd)
+         self.zip = zipfile.ZipFile(self.tmpname, 'w')
+      except Exception as e:
+         self.finish(False, str(e))
+         return
+
+      if self.old and self.old.infolist():
+         # get all hashes from device to check which files are
+         # unmodified in the existing backup
+         self.cmd(Board.HASH, self.on_hash, len(files))
+      else:
+         self.transfer({ })
+
+   def on_hash(self, success, hashes=None):
+      if not success:
+         self.finish(False, self.tr("Hashing failed"))
+         return
+
+      self.transfer(hashes)
+
+   def transfer(self, hashes):
+      old = { i.filename: i for i in self.old.infolist() } if self.old else { }
+
+      # copy all unmodified files first. The archive is written by the
+      # worker thread once files are being read from the board
+      fetch = [ ]
+      try:
+         for path, size in self.files:
+            name = path.lstrip("/")
+            info = old.pop(name, None)
+            digest = entry_digest(self.old, info) if info and hashes.get(path) else None
+            if digest is not None and digest == hashes[path]:
+               self.message.emit(self.tr("Unmodified {}").format(name.split("/")[-1]),
+                                 self.tr("Unmodified {}").format(path))
+               copy_entry(self.old, self.zip, info, DIGEST_PREFIX + digest.hex().encode("ascii"))
+            else:
+               fetch.append( ( path, size ) )
+      except Exception as e:
+         self.finish(False, str(e))
+         return
+
+      # entries of files that don't exist on the board anymore
+      self.removed = list(old)
+
+      # queue all other files to be read at once. The board can then
+      # read them back to back
+      self.pending = len(fetch)
+      for path, size in fetch:
+         self.cmd(Board.GET_FILE, self.on_file,
+                  { "name": path, "size": size, "quiet": True, "sink": self.open_entry } )
+
+      # nothing to read from the board at all
+      if not self.pending:
+         self.finish(True)
+
+   def open_entry(self, parms):
+      # called from the worker thread once a file is being read
+      return BackupEntry(self, parms["name"].lstrip("/"))
+
+   def on_file(self, success, ctx):
+      # the backup may already have been aborted while further
+      # files were still queued
+      if self.zip is None: return
+
+      if not success:
+         self.board.cancel(self.futures)
+         self.finish(False, self.tr("Board com failed"))
+         return
+
+      self.message.emit(self.tr("Backing up {}").format(ctx["name"].split("/")[-1]),
+                        self.tr("Backing up {}").format(ctx["name"]))
+
+      # check if this was the last file
+      self.pending -= 1
+      if not self.pending:
+         self.finish(True)
+
+   def finish(self, ok, msg = ""):
+      with self.lock:
+         zip, self.zip = self.zip, None
+         try:
+            if self.entry:
+               # a file was being written when the backup failed
+               self.entry.fp.close()
+               self.entry.fp = None
+               self.entry = None
+            if zip: zip.close()
+         except Exception as e:
+            if ok: ok, msg = False, str(e)
+
+      if self.old:
+         self.old.close()
+         self.old = None
+
+      try:
+         if ok:
+            os.replace(self.tmpname, self.fname)
+         elif hasattr(self, "tmpname"):
+            os.remove(self.tmpname)
+      except Exception as e:
+         ok, msg = False, str(e)
+
+      self.done.emit(ok, msg)
+
+class Restore(QObject):
+   """ Restore all files of a backup archive to the board. Files whose hash
+   matches the one on the board are skipped. Missing directories are created
+   in one go and all other files are then written back to back """
+
+   message = pyqtSignal(str, str)      # status bar and console message
+   restored = pyqtSignal(str, bytes)   # name and contents of a restored file
+   done = pyqtSignal(bool)
+
+   def __init__(self, board, fname, parent=None):
+      super().__init__(parent)
+      self.board = board
+      self.zip = zipfile.ZipFile(fname, 'r')
+      self.remaining = [ ]
+      self.futures = [ ]
+
+   def cmd(self, cmd, cb, parms=None):
+      # on failure only the commands queued here are cancelled
+      self.futures.append(self.board.cmd(cmd, cb, parms))
+
+   def start(self, files):
+      # files is a list of all files on the board, named like the
+      # entries of the archive without leading slash
+      self.remaining = files
+      self.cmd(Board.HASH, self.on_hash, len(files))
+
+   def on_hash(self, success, hashes=None):
+      if not success:
+         self.finish(False)
+         return
+
+      # directories containing any file are known to exist
+      dirs = set()
+      for f in self.remaining:
+         parts = f.split("/")[:-1]
+         for i in range(len(parts)):
+            dirs.add("/" + "/".join(parts[:i+1]))
+
+      # plan which files need to be written and which directories
+      # need to be created for them
+      uploads = [ ]
+      mkdirs = set()
+      archived = set()
+      try:
+         for info in self.zip.infolist():
+            # don't explicitely restore directories. They are implicitely
+            # restored via the file names. This should actually never happen
+            # with the backup files as they don't explicitely store directories
+            if info.filename.endswith("/"): continue
+            archived.add(info.filename)
+
+            path = "/" + info.filename
+            if path in hashes and hashes[path] == entry_digest(self.zip, info):
+               self.message.emit(self.tr("Unmodified {}").format(path.split("/")[-1]),
+                                 self.tr("Unmodified {}").format(info.filename))
+               continue
+
+            uploads.append(info)
+            parts = info.filename.split("/")[:-1]
+            for i in range(len(parts)):
+               d = "/" + "/".join(parts[:i+1])
+               if not d in dirs: mkdirs.add(d)
+      except Exception as e:
+         print("restore exception", str(e))
+         self.finish(False)
+         return
+
+      # files on the board which were not part of the backup
+      self.remaining = [ f for f in self.remaining if not f in archived ]
+      
+      self.pending = len(uploads)
+      self.total = sum(info.file_size for info in uploads)
+      self.written = 0
+      self.started = time.monotonic()
+      self.finished = False
+      
+      # parents sort before their subdirectories
+      if mkdirs:
+         self.cmd(Board.MKDIRS, self.on_mkdirs, sorted(mkdirs))
+
+      # the files are read from the archive by the worker thread
+      # right before being sent
+      for info in uploads:
+         self.cmd(Board.PUT_FILE, self.on_file,
+                  { "name": "/" + info.filename, "entry": info.filename,
+                    "quiet": True, "source": self.read_entry } )
+
+      if not self.pending:
+         self.finish(True)
+
+   def read_entry(self, parms):
+      # called from the worker thread
+      return self.zip.read(parms["entry"])
+
+   def on_mkdirs(self, success, dirs=None):
+      if self.finished:
+         self.close()
+      elif not success:
+         self.board.cancel(self.futures)
+         self.finish(False)
+
+   def on_file(self, success, parms=None):
+      if self.finished:
+         self.close()
+         return
+      
+      if not success:
+         self.board.cancel(self.futures)
+         self.finish(False)
+         return
+
+      # report throughput and estimated time to finish
+      self.written += len(parms["code"])
+      elapsed = time.monotonic() - self.started
+      rate = self.written / elapsed if elapsed > 0 else 0
+      eta = int((self.total - self.written) / rate) if rate else 0
+      self.message.emit(self.tr("Restored {} ({:.1f} kB/s, {}:{:02d} left)").format(
+                           parms["name"].split("/")[-1], rate / 1024, eta // 60, eta % 60),
+                        self.tr("Restoring {}").format(parms["entry"]))
+      self.restored.emit(parms["name"], parms["code"])
+
+      self.pending -= 1
+      if not self.pending:
+         self.finish(True)
+
+   def close(self):
+      # a command that has already started may still read from the
+      # archive. It's closed once all commands are done
+      if self.zip and all(f.done() for f in self.futures):
+         self.zip.close()
+         self.zip = None
+
+   def finish(self, ok):
+      self.finished = True
+      self.close()
+      self.done.emit(ok)
@@ -24,9 +24,23 @@ import time
 
 import threading
 import binascii
+import hashlib
 from queue import Queue
+from collections import deque
+from concurrent.futures import Future
 import ast
 
+class Command(object):
+   # a command queued for the board worker thread. The future is
+   # resolved with a ( success, result ) tuple once the command has
+   # finished. The callback is invoked from the GUI thread
+   def __init__(self, cmd, cb, parms):
+      self.cmd = cmd
+      self.cb = cb
+      self.parms = parms
+      self.future = Future()
+      self.started = None
+
 class Board(QObject):
    code_downloaded = pyqtSignal()  # callback when code has been downloaded but not yet run
    console = pyqtSignal(bytes)     # data has arrived from console output
@@ -35,6 +49,18 @@ class Board(QObject):
    status = pyqtSignal(str)
    lost = pyqtSignal()
    interactive = pyqtSignal()
+   latency = pyqtSignal(str, float)  # name and duration in ms of a completed command
+   entries = pyqtSignal(list, bool)  # batch of ( path, size, mtime ) records of a running listing
+                                     # and whether directory contents are included
+   wakeup = pyqtSignal()           # internal: worker thread has posted messages
+
+   # minimum time between two console updates while output is streaming
+   CONSOLE_INTERVAL = 0.02
+
+   # directory entries are forwarded to the GUI once this many have been
+   # received or LISTING_INTERVAL has passed, whatever happens first
+   LISTING_BATCH = 256
+   LISTING_INTERVAL = 0.1
    
    # commands
    SCAN = 1
@@ -46,18 +72,172 @@ class Board(QObject):
    REPL = 7
    CONNECT = 8    # on user request with noscan
    HASH = 9
+   MKDIRS = 10
+   REMOVE = 11
+   RM = 12        # a single file or directory with its contents
+   MKDIR = 13
+   RENAME = 14
+
+   NAMES = { SCAN: "scan", GET_VERSION: "version", LISTDIR: "listdir", GET_FILE: "get",
+             PUT_FILE: "put", RUN: "run", REPL: "repl", CONNECT: "connect", HASH: "hash",
+             MKDIRS: "mkdirs", REMOVE: "remove", RM: "rm", MKDIR: "mkdir", RENAME: "rename" }
+
+   # Helper functions used by several commands. Depending on helper_mode
+   # they are either sent along with every command ("off"), installed once
+   # per raw repl session in RAM ("ram") or stored in a hidden file on the
+   # device ("flash"). Bump HELPER_VERSION whenever the helpers change, so
+   # outdated copies get replaced.
+   HELPER_VERSION = 6
+   HELPER_FILE = "/.upide_helper.py"
+   RUN_FILE = "/.upide_run.py"
+   HELPER = (
+      "import uos, hashlib\n"
+      "class _upide:\n"
+      " V=%d\n"
+      # recursively list all entries, one tab separated "<type>\t<size>\t<mtime>\t<path>"
+      # record per line. Directories are listed before their contents which
+      # are only included if r is set. The mtime requires an extra stat per
+      # file and is only included if m is set
+      " def ls(d,m=0,r=1):\n"
+      "  for f in uos.ilistdir(d if d else '/'):\n"
+      #   hide upide's own files in the root directory
+      "   if not d and f[0].startswith('.upide_'): continue\n"
+      "   n=d+'/'+f[0]\n"
+      "   if f[1]&0x4000:\n"
+      "    print('d\\t\\t\\t'+n)\n"
+      "    if r: _upide.ls(n,m,r)\n"
+      "   else:\n"
+      "    print('f\\t{}\\t{}\\t{}'.format(f[3] if len(f)>3 else 0,uos.stat(n)[8] if m else '',n))\n"
+      " def sha1(n):\n"
+      "  try:\n"
+      "   hash = hashlib.sha1()\n"
+      "   with open(n, 'rb') as f:\n"
+      "    data = f.read(1024)\n"
+      "    while data:\n"
+      "     hash.update(data)\n"
+      "     data = f.read(1024)\n"
+      "    return hash.digest()\n"
+      "  except:\n"
+      "   return None\n"
+      # recursively print hash and name of all files, one tab separated
+      # record per line. Files that cannot be read get a '-' as hash. If c
+      # is set the digests are taken from the manifest M as long as size
+      # and mtime of a file haven't changed. The manifest is rewritten
+      # while walking the filesystem, so this only works with d = ''
+      " M='/.upide_hashes'\n"
+      " def hash(d,c=0):\n"
+      "  m=_upide.hload() if c else None\n"
+      "  try:\n"
+      "   o=open(_upide.M+'.tmp','w') if c else None\n"
+      "  except OSError:\n"
+      "   o=None\n"
+      "  _upide.hwalk(d,m,o)\n"
+      "  if o:\n"
+      "   o.close()\n"
+      "   try: uos.remove(_upide.M)\n"
+      "   except OSError: pass\n"
+      "   uos.rename(_upide.M+'.tmp',_upide.M)\n"
+      # the manifest holds "<size>\t<mtime>\t<hex sha1>\t<path>" records,
+      # later records replace earlier ones of the same path
+      " def hload():\n"
+      "  m={}\n"
+      "  try:\n"
+      "   with open(_upide.M) as f:\n"
+      "    for l in f:\n"
+      "     e=l.rstrip('\\n').split('\\t',3)\n"
+      "     if len(e)==4: m[e[3]]=e\n"
+      "  except OSError: pass\n"
+      "  return m\n"
+      " def hwalk(d,m,o):\n"
+      "  for f in uos.ilistdir(d if d else '/'):\n"
+      "   if not d and f[0].startswith('.upide_'): continue\n"
+      "   n=d+'/'+f[0]\n"
+      "   if f[1]&0x4000:\n"
+      "    _upide.hwalk(n,m,o)\n"
+      "    continue\n"
+      "   h=None\n"
+      #   files without mtime cannot be cached
+      "   if m is not None:\n"
+      "    s=uos.stat(n)\n"
+      "    k=[str(s[6]),str(s[8])]\n"
+      "    e=m.pop(n,None)\n"
+      "    if s[8] and e and e[:2]==k: h=e[2]\n"
+      "   if h is None:\n"
+      "    h=_upide.sha1(n)\n"
+      "    h=''.join('%%02x'%%b for b in h) if h else '-'\n"
+      "   if o and s[8] and h!='-': o.write('\\t'.join(k+[h,n])+'\\n')\n"
+      "   print(h,end='\\t')\n"
+      "   print(n)\n"
+      # add the digest of a file just written to the manifest
+      " def hput(n,h):\n"
+      "  s=uos.stat(n)\n"
+      "  if s[8]:\n"
+      "   with open(_upide.M,'a') as f: f.write('{}\\t{}\\t{}\\t{}\\n'.format(s[6],s[8],h,n))\n"
+      # the code run last is kept in R, so running it again doesn't
+      # require it to be sent again
+      " R='/.upide_run.py'\n"
+      " def rsum():\n"
+      "  h=_upide.sha1(_upide.R)\n"
+      "  print(''.join('%%02x'%%b for b in h) if h else '-')\n"
+      #   run in the global namespace just like code sent directly. The
+      #   name makes tracebacks look the same, too
+      " def run():\n"
+      "  with open(_upide.R) as f: c=f.read()\n"
+      "  try: c=compile(c,'<stdin>','exec')\n"
+      "  except NameError: pass\n"
+      "  exec(c,globals())\n"
+      " def rm(n):\n"
+      "  try:\n"
+      "   uos.remove(n)\n"
+      "  except:\n"
+      "   uos.rmdir(n)\n"
+      # rename, copy if renaming fails
+      " def mv(a, b):\n"
+      "  try:\n"
+      "   uos.rename(a, b)\n"
+      "  except:\n"
+      "   with open(a, 'rb') as src, open(b, 'wb') as dst:\n"
+      "    while True:\n"
+      "     buffer = src.read(256)\n"
+      "     if not buffer:\n"
+      "      break\n"
+      "     dst.write(buffer)\n"
+      "   uos.remove(a)\n" ) % HELPER_VERSION
 
    def __init__(self, parent=None):
       super().__init__(parent)
       self.board = None  # not connected yet
+      self.helper_mode = "ram"
+      self.hash_cache = False
+      self.compress = False
+      self.run_cache = False
+      self.capture = None
+      self.helper_installed = False
       self.worker_thread = None
       self.queue = Queue()
       self.interact = False
 
-      # start a timer for frequent event queue polling
-      self.timer = QTimer()
-      self.timer.timeout.connect(self.on_timer)
-      self.timer.start(20)  # poll at 50 Hz
+      # commands waiting to be processed by the worker thread. The lock
+      # serializes all access to the board between the worker thread and
+      # the few synchronous operations done from the GUI thread
+      self.commands = deque()
+      self.commands_cond = threading.Condition()
+      self.lock = threading.RLock()
+      self.current = None  # command currently being processed
+
+      # the worker thread wakes up the GUI thread via a queued signal
+      # whenever it posts a message. Only one wakeup is pending at a time
+      self.wakeup_pending = False
+      self.wakeup_lock = threading.Lock()
+      self.wakeup.connect(self.on_wakeup, Qt.QueuedConnection)
+
+      # console output is collected and forwarded at a limited rate
+      # while it's streaming in
+      self.console_data = bytearray()
+      self.console_sent = 0
+      self.console_timer = QTimer()
+      self.console_timer.setSingleShot(True)
+      self.console_timer.timeout.connect(self.flush_console)
 
       self.soft_reset = False  # disable by default, may be enabled if no LEGO device is detected
 
@@ -67,17 +247,94 @@ class Board(QObject):
       # self.soft_reset = mode
       pass
       
+   def raw_repl(self):
+      # Commands share one raw repl session. It's only entered if the board
+      # isn't already in raw repl and stays active after the command, so
+      # consecutive commands don't pay for entering and leaving it again.
+      if not self.board.in_raw_repl:
+         self.board.enter_raw_repl(self.soft_reset)
+         # the helpers may be gone with a fresh session
+         self.helper_installed = False
+
+   def set_helper_mode(self, mode):
+      self.helper_mode = mode
+      self.helper_installed = False
+
+   def set_compress(self, enabled):
+      # send files deflate compressed if the device can decompress them
+      self.compress = enabled
+
+   def set_run_cache(self, enabled):
+      # keep the code run last on the device and only send it again
+      # if it has changed
+      self.run_cache = enabled
+
+   def set_hash_cache(self, enabled):
+      # keep a manifest of file digests on the device so hashing only
+      # needs to read files that have been modified
+      self.hash_cache = enabled
+
+   def helper(self, call):
+      # return the code to invoke a helper function. This needs to be run
+      # inside the raw repl session
+      if self.helper_mode not in [ "ram", "flash" ]:
+         return Board.HELPER + "_upide." + call + "\n"
+
+      if not self.helper_installed:
+         if self.helper_mode == "flash":
+            # try to load the helpers from flash and check the version
+            version = self.board.exec_(
+               "try:\n"
+               " exec(open('{0}').read())\n"
+               " print(_upide.V)\n"
+               "except OSError:\n"
+               " print(0)\n".format(Board.HELPER_FILE))
+            if version.strip() != str(Board.HELPER_VERSION).encode():
+               self.board.fs_put_stream(Board.HELPER, Board.HELPER_FILE)
+               self.board.exec_(Board.HELPER)
+         else:
+            self.board.exec_(Board.HELPER)
+            
+         self.helper_installed = True
+
+      return "_upide." + call
+
+   def leave_raw_repl(self):
+      # return to the friendly repl. Only needed to run user code or for
+      # interactive mode
+      if self.board.in_raw_repl:
+         self.board.exit_raw_repl()
+
+   def post(self, msg):
+      # queue a message for the GUI thread and wake it up
+      self.queue.put(msg)
+      with self.wakeup_lock:
+         if self.wakeup_pending: return
+         self.wakeup_pending = True
+      self.wakeup.emit()
+      
+   def set_capture(self, capture):
+      # all console data is additionally written to the capture. It's
+      # fed from the worker thread, independent of the gui
+      self.capture = capture
+
    def send_console(self, str):
-      self.queue.put( ( "console",  str ) )
+      capture = self.capture
+      if capture: capture.write(str)
+      self.post( ( "console",  str ) )
       
    def send_status(self, msg):
-      self.queue.put( ( "status", msg ) )
+      self.post( ( "status", msg ) )
        
    def send_progress(self, val):
-      self.queue.put( ( "progress", val ) )
+      self.post( ( "progress", val ) )
        
    def send_result(self, success, res=None):       
-      self.queue.put( ( "result", ( success, res ) ) )
+      # the result belongs to the command currently being processed
+      command = self.current
+      if command and not command.future.done():
+         command.future.set_result( ( success, res ) )
+      self.post( ( "result", command, ( success, res ) ) )
       
    def func_probe_all(self, ports):
       for port in ports:
@@ -117,50 +374,104 @@ class Board(QObject):
       board.exit_raw_repl()
       return board
 
-   def func_wrapper(self, *args):
+   def func_wrapper(self, batch):
       try:
-         # args is a tuple of function and another tuple with its arguments
-         args[0](*args[1])
+         self.execute(batch)
       except Exception as e:
          print("Exception", str(e))
+
+         # the state of the raw repl session is unknown now. Enter it
+         # from scratch with the next command
+         if self.board: self.board.in_raw_repl = False
          
          # something has failed. check if the serial connection is lost
          try:
-            # make sure we call the super class to trigger
-            # hardware problems
-            self.board.serial.super().inWaiting()
-         except:
-            # port seems to be lost
-            self.queue.put( ("lost",) )
-            return
+            # make sure we call the pyserial implementation to trigger
+            # hardware problems, the buffered one may not touch the port
+            serial.Serial.inWaiting(self.board.serial)
+            lost = False
+         except Exception:
+            lost = True
 
-         if not str(e): e = "Unknown exception"
-         
-         # must have been something else. Just report it
-         self.queue.put( ("exception", ("", str(e) )))
-         self.send_result(False)         
-            
-   def do_in_thread(self, func, args=None):
-      """ run worker thread in the background to do the board
-      communication """
+         if not lost:
+            if not str(e): e = "Unknown exception"
 
-      # Check if thread is already active. This should
-      # never happen
-      if self.worker_thread:
-         raise Exception("Worker already running")
+            # must have been something else. Just report it
+            self.post( ("exception", ("", str(e) )))
+
+         # fail all commands of the batch that have not reported yet
+         for command in batch:
+            if not command.future.done():
+               self.current = command
+               self.send_result(False)
+
+         if lost:
+            # port seems to be lost. Nothing queued can succeed anymore
+            self.cancel()
+            self.post( ("lost",) )
+
+   def worker(self):
+      """ process the queued commands one after another in the
+      background to do the board communication """
+      while True:
+         with self.commands_cond:
+            while not self.commands:
+               self.commands_cond.wait()
+            command = self.commands.popleft()
+            if command is None:
+               return      # board is being closed
 
-      # start worker thread to do the actual job ...
-      self.worker_thread = threading.Thread(target=self.func_wrapper, args=(func,args if args else tuple()))
+            # consecutive file reads can be done in one go
+            batch = [ command ]
+            if command.cmd == Board.GET_FILE:
+               while self.commands and self.commands[0] is not None and \
+                     self.commands[0].cmd == Board.GET_FILE:
+                  batch.append(self.commands.popleft())
 
-      self.worker_thread.start()
+         # skip anything that has been cancelled in the meantime
+         batch = [ c for c in batch if c.future.set_running_or_notify_cancel() ]
+         if batch:
+            with self.lock:
+               self.func_wrapper(batch)
+            self.current = None
       
-   def on_timer(self):
-      # frequently poll the worker queue for results
+   def cancel(self, futures=None):
+      # cancel the commands of the given futures or all commands if
+      # none are given. Commands already started are not affected
+      if futures is not None: futures = set(futures)
+      with self.commands_cond:
+         for command in self.commands:
+            if command is not None and (futures is None or command.future in futures):
+               command.future.cancel()
+         self.commands = deque(c for c in self.commands if c is None or not c.future.cancelled())
+
+   def flush_console(self):
+      self.console_timer.stop()
+      if self.console_data:
+         data = bytes(self.console_data)
+         self.console_data = bytearray()
+         self.console_sent = time.monotonic()
+         self.console.emit(data)
+         
+   def on_wakeup(self):
+      # process all messages the worker thread has posted so far
+      with self.wakeup_lock:
+         self.wakeup_pending = False
 
-      console_data = b""
       while not self.queue.empty():
          msg = self.queue.get()
 
+         if msg[0] == "console":
+            # console output may happen pretty fast. Writing single bytes
+            # to the output will slow things down pretty much. So we
+            # collect data and return the whole message.
+            self.console_data += msg[1]
+            continue
+         
+         # output pending console data first, so it isn't delayed
+         # after e.g. exception output or a command result
+         self.flush_console()
+         
          # message from worker thread to be displayed in the status bar
          if msg[0] == "status":
             self.status.emit(msg[1])
@@ -169,20 +480,8 @@ class Board(QObject):
             self.progress.emit(msg[1])
             
          if msg[0] == "exception":
-            # output pending console data, so it isn't delayed
-            # after the exception output
-            if console_data:
-               self.console.emit(console_data)
-               console_data = b""
-            
             self.error.emit(msg[1][0], msg[1][1])
             
-         if msg[0] == "console":
-            # console output may happen pretty fast. Writing single bytes
-            # to the output will slow things down pretty much. So we
-            # collect data and return the whole message.
-            console_data += msg[1]
-
          if msg[0] == "downloaded":
             self.code_downloaded.emit()
             
@@ -190,20 +489,34 @@ class Board(QObject):
             self.interactive.emit()
             
          if msg[0] == "lost":
-            self.worker_thread = None
             self.lost.emit()
             
-         # check if the command has sent a result ...
+         if msg[0] == "entries":
+            self.entries.emit(msg[1], msg[2])
+            
+         # check if a command has sent a result ...
          if msg[0] == "result":
+            command = msg[1]
+            
+            # report how long the command took. Running code and the
+            # interactive mode take as long as the user wants
+            if command.started and command.cmd not in [ Board.RUN, Board.REPL ]:
+               self.latency.emit(Board.NAMES[command.cmd], 1000 * (time.monotonic() - command.started))
+            
             # invoke callback if present
-            self.worker_thread = None
-            if self.cb: self.cb(msg[1][0], msg[1][1])
+            if command.cb: command.cb(msg[2][0], msg[2][1])
 
-      # forward accumulated serial data to the console
-      if console_data:
-         self.console.emit(console_data)
+      # forward accumulated serial data to the console. Sporadic output
+      # (e.g. typing in interactive mode) is forwarded immediately, a stream
+      # of data is coalesced into updates every CONSOLE_INTERVAL
+      if self.console_data and not self.console_timer.isActive():
+         delay = self.console_sent + Board.CONSOLE_INTERVAL - time.monotonic()
+         if delay <= 0:
+            self.flush_console()
+         else:
+            self.console_timer.start(int(1000 * delay) + 1)
 
-   def scan(self, port = None):
+   def scan_ports(self, port = None):
       ports = serial.tools.list_ports.comports()
 
       # if the given port is in the list, then move it
@@ -220,8 +533,7 @@ class Board(QObject):
          if port != p.device:
             ports_sorted.append(p)
 
-      # probe all ports in background thread
-      self.do_in_thread(self.func_probe_all, ( ports_sorted, ))
+      return ports_sorted
       
    def reply_handle_line_ast(self, line = None):
       if line != None:
@@ -230,28 +542,45 @@ class Board(QObject):
          self.result = ast.literal_eval(line)
        
    def reply_parser(self, data = None, line_parser = None):
-      # reply_parser collects data returned from micropython.
+      # reply_parser collects data returned from micropython and hands
+      # every complete line to the line_parser. A single chunk of data
+      # may contain any number of lines
       
       # if the parser is called without any data at all then
       # the buffer is to be flushed
       if data is None:
-         self.reply_buffer = b''
+         self.reply_buffer = bytearray()
          self.result = None
          return
 
-      # append data to buffer
-      self.reply_buffer += data
+      # only the newly arrived data needs to be searched as the
+      # buffer never holds a complete line between two calls
+      buffer = self.reply_buffer
+      scan = len(buffer)
+      buffer += data
 
-      # check if data contains a complete line
-      if b'\n' in self.reply_buffer:            
-         line, self.reply_buffer = self.reply_buffer.split(b'\n', 1)
-         line_parser(line.decode("utf-8"))
-            
       # x04 in buffer (should) means that this is the end of the message
-      if b'\x04' in self.reply_buffer:
-         line, self.reply_buffer = self.reply_buffer.split(b'\x04', 1)
-         if len(line): line_parser(line.decode("utf-8"))                
-         line_parser()
+      end = buffer.find(b'\x04', scan)
+      limit = end if end >= 0 else len(buffer)
+
+      start = 0
+      view = memoryview(buffer)
+      try:
+         while True:
+            nl = buffer.find(b'\n', scan, limit)
+            if nl < 0: break
+            line_parser(str(view[start:nl], "utf-8"))
+            start = scan = nl + 1
+
+         if end >= 0:
+            if end > start: line_parser(str(view[start:end], "utf-8"))
+            line_parser()
+            start = end + 1
+      finally:
+         # the buffer cannot be resized while the view exists
+         view.release()
+
+      del buffer[:start]
 
    def reply_parser_ast(self, data = None):
       self.reply_parser(data, self.reply_handle_line_ast)
@@ -268,116 +597,193 @@ class Board(QObject):
 
    def func_version(self):
       # print a ast.eval parsable dict
-      self.func("import os\r"
+      # mpy describes the .mpy files the device can import
+      self.func("import os, sys\r"
              "o = os.uname()\r"
              "v = { 'sysname': o.sysname, 'nodename': o.nodename, "
                    "'release': o.release, 'version': o.version, "
-                   "'machine': o.machine }\r"
+                   "'machine': o.machine, 'mpy': getattr(sys.implementation, '_mpy', 0) }\r"
              "print(v)")
 
-   def version(self):
-      self.do_in_thread(self.func_version)
-
    def func(self, cmd, parser=None):
       self.reply_parser()           # reset parser
-      self.board.enter_raw_repl(self.soft_reset)
+      self.raw_repl()
       self.board.exec_(cmd, data_consumer=parser if parser else self.reply_parser_ast)
-      self.board.exit_raw_repl()
       self.send_result(True, self.result)
       
-   def func_ls(self):
-      # recursively scan all files. The result should be a single line
-      # of parsable python, so it can be eval'uated on PC side
-      self.func(
-         "import uos\n"
-         "def _list(d):\n"
-         " print('[',end='')\n"
-         " first=True\n"
-         " for f in uos.ilistdir(d if d else '/'):\n"
-         #  make sure we have a comma before anything but the first entry
-         "  if first: first=False\n"
-         "  else:     print(',',end='')\n"
-         "  print('(\"{}\",'.format(f[0].replace('\"','\\\\\\\"')), end='')\n"
-         "  if f[1]&0x4000: _list(d+'/'+f[0].replace('\"','\\\\\\\"'))\n"
-         "  else: print('{}'.format(f[3] if len(f)>3 else 0), end='')\n"
-         "  print(')', end='')\n"
-         " print(']',end='')\n"
-         "_list('')\n"
-      )
-
-   def ls(self):
-      self.do_in_thread(self.func_ls)
-
-   def func_get(self, src, size, reply_parms, chunk_size=256):
+   def reply_handle_line_ls(self, line=None):
+      # each line is a "<type>\t<size>\t<mtime>\t<path>" record. The
+      # entries are forwarded in batches while the listing is running
+      if line != None:
+         line = line.rstrip('\r')
+         if line == "": return
+         kind, size, mtime, path = line.split('\t', 3)
+         self.listing.append( ( path, int(size) if kind == 'f' else None, int(mtime) if mtime else None ) )
+         self.result += 1
+         if len(self.listing) < Board.LISTING_BATCH and time.monotonic() < self.listing_due:
+            return
+
+      if self.listing:
+         self.post( ( "entries", self.listing, self.listing_recursive ) )
+         self.listing = [ ]
+      self.listing_due = time.monotonic() + Board.LISTING_INTERVAL
+      
+   def ls_line_parser(self, data=None):
+      self.reply_parser(data, self.reply_handle_line_ls)
+
+   def func_ls(self, reply_parms):
+      # list a single directory or recursively scan all files below it.
+      # The entries are sent via the entries signal while the scan is
+      # running, their number is added to the result
+      self.reply_parser()           # reset parser
+      self.result = 0
+      self.listing = [ ]
+      self.listing_recursive = reply_parms["recursive"]
+      self.listing_due = time.monotonic() + Board.LISTING_INTERVAL
+      self.raw_repl()
+      self.board.exec_(self.helper("ls('{0}',0,{1})".format(reply_parms["path"], int(reply_parms["recursive"]))),
+                       data_consumer=self.ls_line_parser)
+      reply_parms["entries"] = self.result
+      self.send_result(True, reply_parms)
+
+   def func_get(self, src, size, reply_parms, chunk_size=4096):
       self.reply_parser()           # reset parser
-      self.board.enter_raw_repl(self.soft_reset)
+      self.raw_repl()
 
-      self.board.exec_("f=open('%s','rb')\nr=f.read" % src)
+      # the whole file is streamed in one go and decoded on the fly. If
+      # the command comes with a sink, then the data is written to the
+      # file object it returns instead of being returned as "code"
+      sink = reply_parms["sink"](reply_parms) if "sink" in reply_parms else None
       result = bytearray()
-      while True:
-         data = bytearray()
-         self.board.exec_("print(r(%u))" % chunk_size, data_consumer=lambda d: data.extend(d))
-         assert data.endswith(b"\r\n\x04")
-         try:
-            data = ast.literal_eval(str(data[:-3], "ascii"))
-            if not isinstance(data, bytes):
-               raise ValueError("Not bytes")
-         except (UnicodeError, ValueError) as e:
-            raise pyboard.PyboardError("fs_get: Could not interpret received data: %s" % str(e))
-         if not data:
-            break
-         
-         result += data
-         self.send_progress(100 * len(result) // size)
+      received = 0
+      def on_data(data):
+         nonlocal received
+         if sink: sink.write(data)
+         else:    result.extend(data)
+         received += len(data)
+         if size: self.send_progress(100 * received // size)
 
-      self.board.exec_("f.close()")
+      try:
+         self.board.fs_stream(src, on_data, chunk_size)
+      finally:
+         if sink: sink.close()
       
-      self.board.exit_raw_repl()
-      reply_parms["code"] = result   # add data read to reply
+      if not sink: reply_parms["code"] = result   # add data read to reply
       self.send_result(True, reply_parms )
       
-   def get(self, name, size, reply_parms):
-      self.progress.emit(0)
-      if not "quiet" in reply_parms:
-         self.status.emit(self.tr("Reading {}").format(name.split("/")[-1]))
-      self.do_in_thread(self.func_get, ( name, size, reply_parms ) )
+   def func_get_many(self, commands, chunk_size=4096):
+      # read the files of several GET_FILE commands in one exec. Each
+      # command still receives its own result
+      self.raw_repl()
+
+      # data of commands with a sink is written to it, all other
+      # files are collected in memory
+      files = { }
+      def on_data(index, data):
+         if not index in files:
+            parms = commands[index].parms
+            files[index] = parms["sink"](parms) if "sink" in parms else bytearray()
+         if isinstance(files[index], bytearray): files[index].extend(data)
+         else:                                   files[index].write(data)
+
+      def on_progress(index, received):
+         parms = commands[index].parms
+         if not received:
+            self.current = commands[index]
+            if not "quiet" in parms:
+               self.send_status(self.tr("Reading {}").format(parms["name"].split("/")[-1]))
+         if parms["size"]: self.send_progress(100 * received // parms["size"])
+
+      def on_file(index, data, error):
+         self.current = commands[index]
+         parms = commands[index].parms
+         if error:
+            self.post( ("exception", ("", error )))
+            self.send_result(False)
+            return
+         
+         # empty files never received any data
+         if not index in files: on_data(index, b"")
+         data = files.pop(index)
+         if isinstance(data, bytearray): parms["code"] = data
+         else:                           data.close()
+         self.send_result(True, parms)
+
+      try:
+         self.board.fs_stream_many([ c.parms["name"] for c in commands ],
+                                   on_file, on_progress, chunk_size, on_data)
+      finally:
+         # close the sinks of files that were interrupted
+         for f in files.values():
+            if not isinstance(f, bytearray): f.close()
        
-   def func_put(self, all_data, dest, chunk_size=256):
+   def func_put(self, all_data, dest, reply_parms=None, chunk_size=1024):
       self.reply_parser()           # reset parser
-      self.board.enter_raw_repl(self.soft_reset)
-      size = len(all_data)
-      sent = 0
-      
-      self.board.exec_("f=open('%s','wb')\nw=f.write" % dest)
-      while True:
-         if all_data != None and len(all_data) > chunk_size:
-            data = all_data[0:chunk_size]
-            all_data = all_data[chunk_size:]
-         else:
-            data = all_data
-            all_data = None
-         
-         if not data: break
-         self.board.exec_("w(" + repr(data) + ")")
-         sent += len(data)
+      self.raw_repl()
+
+      # the data is streamed into a receiver running on the device
+      def on_progress(sent, size):
          self.send_progress(100 * sent // size)
-      self.board.exec_("f.close()")
+      
+      self.put_stream(all_data, dest, chunk_size, on_progress)
 
-      self.board.exit_raw_repl()
-      self.status.emit("")     # clear status 
-      self.send_result(True)   # TOOD: add parms
-       
-   def put(self, data, name):
-      self.progress.emit(0)
-      self.status.emit(self.tr("Writing {}").format(name.split("/")[-1]))
-      self.do_in_thread(self.func_put, ( data, name ))
+      if self.hash_cache:
+         # record the digest of the new contents in the hash manifest. A
+         # failure here only means that the file has to be hashed later
+         data = all_data.encode("utf-8") if isinstance(all_data, str) else all_data
+         path = dest if dest.startswith("/") else "/" + dest
+         try:
+            self.board.exec_(self.helper("hput('{0}','{1}')".format(path, hashlib.sha1(data).hexdigest())))
+         except pyboard.PyboardError:
+            pass
+
+      self.send_status("")     # clear status 
+      self.send_result(True, reply_parms)
+
+   def put_stream(self, data, dest, chunk_size, progress_callback):
+      if self.compress:
+         self.board.fs_put_deflate(data, dest, chunk_size, progress_callback=progress_callback)
+      else:
+         self.board.fs_put_stream(data, dest, chunk_size, progress_callback=progress_callback)
+
+   def func_mkdirs(self, names):
+      # create several directories in a single exec. Parents have to be
+      # given before their subdirectories, existing ones are skipped
+      self.raw_repl()
+      self.board.exec_("import os\nfor d in %r:\n try:\n  os.mkdir(d)\n except OSError:\n  pass" % list(names))
+      self.send_result(True, names)
+
+   def func_remove(self, names):
+      # remove several files in a single exec. Files that don't exist
+      # (anymore) are skipped
+      self.raw_repl()
+      self.board.exec_("import os\nfor f in %r:\n try:\n  os.remove(f)\n except OSError:\n  pass" % list(names))
+      self.send_result(True, names)
 
    def func_run(self, name, code):
       self.reply_parser()           # reset parser
-      self.board.enter_raw_repl(self.soft_reset)
-      
-      self.board.exec_raw_no_follow(code)
-      self.queue.put( ( "downloaded", ) )
+      self.raw_repl()
+
+      cached = False
+      if self.run_cache:
+         # only send the code if it differs from the copy run last
+         data = code.encode("utf-8") if isinstance(code, str) else code
+         try:
+            if self.board.exec_(self.helper("rsum()")).strip() != hashlib.sha1(data).hexdigest().encode():
+               def on_progress(sent, size):
+                  self.send_progress(100 * sent // size)
+               self.put_stream(data, Board.RUN_FILE, 1024, on_progress)
+            cached = True
+         except pyboard.PyboardError:
+            # e.g. the filesystem is full or read-only. The code
+            # can still be sent directly
+            pass
+
+      if cached:
+         self.board.exec_raw_no_follow(self.helper("run()"))
+      else:
+         self.board.exec_raw_no_follow(code)
+      self.post( ( "downloaded", ) )
       report_exception = None
       
       try:
@@ -387,9 +793,11 @@ class Board(QObject):
       except Exception as e:
          # host side reported an exception
          ret_err = str(e)
-         self.queue.put( ( "exception", (name, "Internal exception:\n" + ret_err) ) )
-         
-      self.board.exit_raw_repl()
+         self.post( ( "exception", (name, "Internal exception:\n" + ret_err) ) )
+
+      # user code may have left the board in any state. So leave the
+      # session and start a fresh one with the next command
+      self.leave_raw_repl()
       self.send_result(not ret_err, None)
 
       # report a device side exception _after_ the program has stopped
@@ -398,21 +806,26 @@ class Board(QObject):
       # is not possible while the thread dealing with the code execution
       # is still running
       if report_exception:
-         self.queue.put( ( "exception", (name, report_exception) ) )
+         self.post( ( "exception", (name, report_exception) ) )
       
-   def run(self, name, code):
-      self.do_in_thread(self.func_run, ( name, code ))
-
    def reply_handle_line_hash(self, line=None):
+      # each line is a "<hex sha1>\t<path>" record
       if self.result == None:
          self.result = { }
-
-      if hasattr(self, "file_num"):
-         self.send_progress(100 * len(self.result) // self.file_num )
+         self.hash_percent = -1
 
       if line != None:
-         d = ast.literal_eval(line)
-         self.result[d[0]] = d[1]
+         line = line.rstrip('\r')
+         if line == "": return
+         digest, name = line.split('\t', 1)
+         self.result[name] = bytes.fromhex(digest) if digest != '-' else None
+
+      # only report progress if it has actually changed
+      if getattr(self, "file_num", 0):
+         percent = 100 * len(self.result) // self.file_num
+         if percent != self.hash_percent:
+            self.hash_percent = percent
+            self.send_progress(percent)
       
    def hash_line_parser(self, data=None):
       self.reply_parser(data, self.reply_handle_line_hash)
@@ -421,28 +834,9 @@ class Board(QObject):
       self.file_num = num
       
       # recursively scan all files and return the hashes
-      self.func(
-         "import uos, hashlib\n"
-         "def _hash(n):\n"
-         " try:\n"
-         "  hash = hashlib.sha1()\n"
-         "  with open(n, 'rb') as f:\n"
-         "   data = f.read(1024)\n"
-         "   while data:\n"
-         "    hash.update(data)\n"
-         "    data = f.read(1024)\n"
-         "   return hash.digest()\n"
-         " except:\n"
-         "  return None\n"
-         "def _list(d):\n"
-         " for f in uos.ilistdir(d if d else '/'):\n"
-         "   if f[1]&0x4000: _list(d+'/'+f[0])\n"
-         "   else: print( ( (d+'/'+f[0]).replace('\"','\\\\\\\"'), _hash(d+'/'+f[0] ) ) )\n"
-         "_list('')\n", self.hash_line_parser)
+      self.raw_repl()
+      self.func(self.helper("hash('',{})".format(int(self.hash_cache))), self.hash_line_parser)
          
-   def hash(self, num):
-      self.do_in_thread(self.func_hash, ( num, ) )
-      
    def stop(self):
       if self.interact:
          # stop the repl process
@@ -457,41 +851,25 @@ class Board(QObject):
    def forceStop(self):
       self.board._interrupt = True
       
-   def replDo(self, cmd):
-      self.board.enter_raw_repl(self.soft_reset)
-      ret = self.board.exec_(cmd)
-      self.board.exit_raw_repl()
-      return ret
-      
-   def rm(self, filename):
-      """Remove the specified file or directory."""
-      self.replDo( (
-        "import os\n"
-        "try:\n"
-        " os.remove('{0}')\n"
-        "except:\n"
-        " os.rmdir('{0}')\n").format(filename))
-           
-   def mkdir(self, filename):
-      """Crete a directory."""
-      self.replDo( "import os\nos.mkdir('{0}')\n".format(filename) )
-
-   def rename(self, old, new):
-      """Rename the specified file or directory. Copy it if renaming fails"""
-      self.replDo( (
-        "import os\n"
-        "try:\n" 
-        " os.rename('{0}', '{1}')\n" 
-        "except:\n" 
-        " with open('{2}', 'rb') as src, open('{3}', 'wb') as dst:\n" 
-        "  while True:\n" 
-        "   buffer = src.read(256)\n" 
-        "   if not buffer:\n" 
-        "    break\n" 
-        "   dst.write(buffer)\n" 
-        " os.remove('{4}')\n" ).format(old, new, old, new, old))
+   def func_fs(self, cmd, parms, helper=False):
+      # run a file system operation. If helper is set then cmd is a call
+      # into the helper functions. An exception raised by the device is
+      # returned in the parms as "error"
+      self.raw_repl()
+      try:
+         self.board.exec_(self.helper(cmd) if helper else cmd)
+      except pyboard.PyboardError as e:
+         # anything else leaves the session in an unknown state
+         if len(e.args) != 3: raise
+         parms["error"] = e
+         self.send_result(False, parms)
+         return
+      self.send_result(True, parms)
 
    def func_interactive(self):
+      # interactive mode uses the friendly repl
+      self.leave_raw_repl()
+      
       # try to interrupt the board
       self.board.serial.write(b"\r\x03")      
       time.sleep(0.1)
@@ -507,7 +885,7 @@ class Board(QObject):
       data = self.board.read_until(1, b"\r\n>>> ")
       if data.endswith(b"\r\n>>> "):
          self.interact = True
-         self.queue.put( ( "interactive", True ) )  # tell console that we are now interactive
+         self.post( ( "interactive", True ) )  # tell console that we are now interactive
 
          # cut any leading newlines
          while data.startswith(b"\r\n"):
@@ -519,56 +897,104 @@ class Board(QObject):
             num = self.board.serial.inWaiting()
             if num > 0:
                self.send_console(self.board.serial.read(num))
-            time.sleep(0.01)
+            elif hasattr(self.board.serial, "wait"):
+               # wait for data, but wake up regularly to check for stop
+               self.board.serial.wait(0.1)
+            else:
+               time.sleep(0.01)
       else:
          raise RuntimeError(self.tr("Failed to enter repl"))
 
       self.send_result(True)
       
-   def start_interactive(self):
-      self.do_in_thread(self.func_interactive)
-
    def func_connect(self, port):
       self.board = self.probe(port)
       self.send_result(self.board != None)
       
-   def connect(self, port):
-      self.do_in_thread(self.func_connect, (port,))
+   def execute(self, batch):
+      # run a batch of commands in the worker thread
+      command = batch[0]
+      cmd, parms = command.cmd, command.parms
       
-   def cmd(self, cmd, cb, parms = None):
-      self.progress.emit(-1)
-
-      self.cb = cb   # save callback for later usage
+      self.current = command
+      for c in batch: c.started = time.monotonic()
+      self.send_progress(-1)
       
       if cmd == Board.SCAN:
-         self.scan(parms["port"] if parms and "port" in parms else None)
+         self.func_probe_all(self.scan_ports(parms["port"] if parms and "port" in parms else None))
 
       elif cmd == Board.GET_VERSION:         
-         self.version()
+         self.func_version()
 
       elif cmd == Board.LISTDIR:
-         self.ls()
+         # list everything if no specific directory was requested
+         self.func_ls(parms if parms else { "path": "", "recursive": True })
 
       elif cmd == Board.HASH:
-         self.hash(parms)
+         self.func_hash(parms)
 
       elif cmd == Board.GET_FILE:
          # all parms are returned with the callback so the receiving
          # side knows what to do with it
-         self.get(parms["name"], parms["size"], parms)
+         if len(batch) > 1:
+            self.func_get_many(batch)
+         else:
+            self.send_progress(0)
+            if not "quiet" in parms:
+               self.send_status(self.tr("Reading {}").format(parms["name"].split("/")[-1]))
+            self.func_get(parms["name"], parms["size"], parms)
          
       elif cmd == Board.PUT_FILE:
-         self.put(parms["code"], parms["name"])
+         self.send_progress(0)
+         if not "quiet" in parms:
+            self.send_status(self.tr("Writing {}").format(parms["name"].split("/")[-1]))
+         # the data may only be fetched now, so not all of the files
+         # queued have to be kept in memory
+         if "source" in parms: parms["code"] = parms["source"](parms)
+         self.func_put(parms["code"], parms["name"], parms)
+
+      elif cmd == Board.MKDIRS:
+         self.func_mkdirs(parms)
+
+      elif cmd == Board.REMOVE:
+         self.func_remove(parms)
+
+      elif cmd == Board.RM:
+         # remove the specified file or directory
+         self.func_fs("rm('{0}')".format(parms["name"]), parms, True)
+
+      elif cmd == Board.MKDIR:
+         self.func_fs("import os\nos.mkdir('{0}')\n".format(parms["name"]), parms)
+
+      elif cmd == Board.RENAME:
+         # rename the specified file or directory. Copy it if renaming fails
+         self.func_fs("mv('{0}', '{1}')".format(parms["name"], parms["new"]), parms, True)
 
       elif cmd == Board.RUN:
-         self.run(parms["name"], parms["code"])
+         self.func_run(parms["name"], parms["code"])
 
       elif cmd == Board.REPL:
-         self.start_interactive()
+         self.func_interactive()
          
       elif cmd == Board.CONNECT:
-         self.connect(parms)
+         self.func_connect(parms)
          
+   def cmd(self, cmd, cb, parms = None):
+      """ queue a command for the worker thread. The callback is invoked
+      with the result once the command has been processed. The returned
+      future may be used to cancel the command before it has started """
+      command = Command(cmd, cb, parms)
+      with self.commands_cond:
+         self.commands.append(command)
+         self.commands_cond.notify()
+
+      # start the worker thread if it's not running yet
+      if not self.worker_thread:
+         self.worker_thread = threading.Thread(target=self.worker, daemon=True)
+         self.worker_thread.start()
+
+      return command.future
+      
    def getPort(self):
       try:
          port = self.board.serial.port
@@ -585,12 +1011,17 @@ class Board(QObject):
          self.interact = False
          time.sleep(.1)
          
-      # kill any running thread
+      # drop all pending commands and stop the worker thread
+      self.cancel()
       if self.worker_thread:
+         with self.commands_cond:
+            self.commands.append(None)
+            self.commands_cond.notify()
          try:
             self.worker_thread.join(10)
          except:
             pass
+         self.worker_thread = None
 
       if self.board:
          self.board.close()
@@ -19,44 +19,169 @@
 #
 
 import serial
+import os, select
 
 __version__ = serial.__version__
 
 class Serial(serial.Serial):
+    # initial size of the receive ring buffer. It grows if more data
+    # arrives than can be stored
+    BUFFER_SIZE = 64*1024
+
     def __init__(self, device, **kwargs):
       super().__init__(device, **kwargs)
-      self._buffer = b""
-      
+
+      # the buffer is a preallocated bytearray used as a ring. _head
+      # is the offset of the oldest byte and _used the number of
+      # bytes stored. Nothing is ever copied around inside the buffer
+      # unless it has to grow
+      self._buffer = bytearray(self.BUFFER_SIZE)
+      self._view = memoryview(self._buffer)
+      self._head = 0
+      self._used = 0
+
+    def _grow(self, num):
+        # make room for at least num bytes. The contents is linearized
+        # while being copied into the new buffer
+        size = len(self._buffer)
+        while size < num: size *= 2
+        buffer = bytearray(size)
+        self._copy_out(memoryview(buffer), self._used)
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._head = 0
+
+    def _append(self, data):
+        if self._used + len(data) > len(self._buffer):
+            self._grow(self._used + len(data))
+
+        # copy into the free space behind the stored data which
+        # may wrap around the end of the buffer
+        size = len(self._buffer)
+        tail = (self._head + self._used) % size
+        first = min(len(data), size - tail)
+        self._view[tail:tail+first] = data[:first]
+        if first < len(data):
+            self._view[:len(data)-first] = data[first:]
+        self._used += len(data)
+
+    def _copy_out(self, dest, num):
+        # copy num bytes from the head of the ring into dest
+        size = len(self._buffer)
+        first = min(num, size - self._head)
+        dest[:first] = self._view[self._head:self._head+first]
+        if first < num:
+            dest[first:num] = self._view[:num-first]
+
+    def _consume(self, num):
+        self._head = (self._head + num) % len(self._buffer)
+        self._used -= num
+        # start over at the begin of the buffer once it's empty, so
+        # the data will rarely wrap
+        if not self._used:
+            self._head = 0
+
+    def _fill(self):
+        # buffer everything available without blocking
+        available = super().inWaiting()
+        if available:
+            self._append(super().read(available))
+
     def inWaiting(self):
         # return anything in buffer, avoid calling super().inWaiting()
         # as it is the culprit for the slow performance
-        if len(self._buffer):
-            return len(self._buffer)
-        
+        if self._used:
+            return self._used
+
         return super().inWaiting()
 
+    def wait(self, timeout):
+        # block until data is available or the timeout expires. Returns
+        # True if there's data to be read
+        if self._used or super().inWaiting():
+            return True
+
+        if os.name == "posix":
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            return bool(ready)
+
+        # there's no way to wait for a windows com port without
+        # reading. So read one byte with the timeout adjusted
+        saved = self.timeout
+        self.timeout = timeout
+        try:
+            data = super().read(1)
+        finally:
+            self.timeout = saved
+        if data:
+            self._append(data)
+        return bool(data)
+
+    def peek(self, num):
+        # return up to num bytes without removing them from the buffer
+        if self._used < num:
+            self._fill()
+
+        num = min(num, self._used)
+        retval = bytearray(num)
+        self._copy_out(memoryview(retval), num)
+        return bytes(retval)
+
+    def find(self, ending, start=0):
+        # return the offset of ending in the buffered data or -1. Data
+        # available at the port is pulled into the buffer first
+        self._fill()
+
+        size = len(self._buffer)
+        end = self._head + self._used
+        if end <= size:
+            # data is contiguous
+            pos = self._buffer.find(ending, self._head + start, end)
+            return pos - self._head if pos >= 0 else -1
+
+        # data wraps. Search the upper part first, then the range
+        # crossing the end of the buffer and finally the lower part
+        upper = size - self._head
+        if start < upper:
+            pos = self._buffer.find(ending, self._head + start, size)
+            if pos >= 0: return pos - self._head
+
+            # a match crossing the end starts within the last
+            # len(ending)-1 bytes of the upper part, independent of
+            # how many bytes have wrapped into the lower part
+            overlap = min(len(ending) - 1, end - size)
+            if overlap > 0:
+                lo = max(start, upper - (len(ending) - 1))
+                border = bytes(self._view[self._head + lo:size]) + bytes(self._view[:overlap])
+                pos = border.find(ending)
+                if pos >= 0: return lo + pos
+
+        pos = self._buffer.find(ending, max(start - upper, 0), end - size)
+        return upper + pos if pos >= 0 else -1
+
+    def read_into(self, buf):
+        # fill buf with as much data as is available without blocking
+        # and return the number of bytes copied
+        if self._used < len(buf):
+            self._fill()
+
+        num = min(len(buf), self._used)
+        self._copy_out(memoryview(buf), num)
+        self._consume(num)
+        return num
+
     def read(self, num):
-        # check if buffer can already satisfy request
-        if len(self._buffer) >= num:
-            retval = self._buffer[:num]
-            self._buffer = self._buffer[num:]
-            return retval
-        
-        # otherwise buffer everything available
-        available = super().inWaiting()
-        if available:
-            self._buffer += super().read(available)
+        # check if buffer can already satisfy request. Otherwise
+        # buffer everything available
+        if self._used < num:
+            self._fill()
 
-        # check if buffer is now sufficient
-        if len(self._buffer) >= num:
-            retval = self._buffer[:num]
-            self._buffer = self._buffer[num:]
-            return retval
+        # return as much as possible from the buffer
+        retval = bytearray(min(num, self._used))
+        self.read_into(retval)
+        if len(retval) == num:
+            return bytes(retval)
 
         # nah, still not enough data, append more even if
         # that might block ...
-        data = self._buffer + super().read(num - len(self._buffer))
-
-        # we'll return all data read, so buffer is now empty
-        self._buffer = b""     
-        return data
+        return bytes(retval) + super().read(num - len(retval))
@@ -0,0 +1,173 @@
+#
+# capture.py
+#
+# Copyright (C) 2021 Till Harbaum <till@harbaum.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51 Franklin
+# Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# A capture file starts with a header followed by records of console data:
+#
+#   header: MAGIC, <q wall clock ns> <Q monotonic ns> at the time it was created
+#   record: <Q monotonic ns> <I length> <length bytes of raw data>
+#
+# The record headers allow to skip through a file without reading the data.
+# Files are rotated like logging's RotatingFileHandler does, name is the
+# current file, name.1 the one before and so on.
+
+import os, time, struct, threading, queue
+
+MAGIC = b"UPIDECAP1\n"
+HEADER = struct.Struct("<qQ")
+RECORD = struct.Struct("<QI")
+
+class Capture(object):
+   """ Write the raw console stream into rotating capture files. Data is
+   handed over to a writer thread, so write() never blocks on disk io and
+   can be called from any thread """
+
+   def __init__(self, name, max_bytes=16*1024*1024, backups=8):
+      self.name = name
+      self.max_bytes = max_bytes
+      self.backups = backups
+      self.queue = queue.SimpleQueue()
+      self.error = None
+      self.file = self.open()
+      self.thread = threading.Thread(target=self.writer, daemon=True)
+      self.thread.start()
+
+   def write(self, data):
+      self.queue.put( ( time.monotonic_ns(), bytes(data) ) )
+
+   def close(self):
+      self.queue.put(None)
+      self.thread.join()
+
+   def open(self):
+      f = open(self.name, 'wb')
+      f.write(MAGIC + HEADER.pack(time.time_ns(), time.monotonic_ns()))
+      return f
+
+   def rotate(self):
+      self.file.close()
+      for i in range(self.backups - 1, 0, -1):
+         src = "{}.{}".format(self.name, i)
+         if os.path.exists(src):
+            os.replace(src, "{}.{}".format(self.name, i + 1))
+      if self.backups:
+         os.replace(self.name, self.name + ".1")
+      self.file = self.open()
+
+   def writer(self):
+      while True:
+         # write everything queued so far before flushing
+         item = self.queue.get()
+         while item is not None:
+            if self.file: self.store(*item)
+            try:
+               item = self.queue.get_nowait()
+            except queue.Empty:
+               break
+         if self.file: self.store()
+
+         if item is None:
+            if self.file: self.file.close()
+            return
+
+   def store(self, t=None, data=None):
+      # write a record or flush if none is given. After an error, e.g.
+      # disk full, nothing is written anymore but the queue is still
+      # drained, so it can't grow without limit
+      try:
+         if data is None:
+            self.file.flush()
+            return
+         if self.file.tell() + RECORD.size + len(data) > self.max_bytes:
+            self.rotate()
+         self.file.write(RECORD.pack(t, len(data)))
+         self.file.write(data)
+      except (OSError, ValueError) as e:
+         self.error = str(e)
+         try:
+            self.file.close()
+         except (OSError, ValueError):
+            pass
+         self.file = None
+
+class CaptureReader(object):
+   """ Read a capture file. Timestamps are given as monotonic ns like
+   in the file, wallclock() converts them """
+
+   def __init__(self, name):
+      self.file = open(name, 'rb')
+      if self.file.read(len(MAGIC)) != MAGIC:
+         self.file.close()
+         raise ValueError("Not a capture file")
+      self.wall, self.mono = HEADER.unpack(self.file.read(HEADER.size))
+      self.start = self.file.tell()
+
+   def close(self):
+      self.file.close()
+
+   def wallclock(self, t):
+      return (self.wall + t - self.mono) / 1e9
+
+   def index(self):
+      """ yield ( timestamp, offset, length ) of all records without
+      reading their data """
+      offset = self.start
+      self.file.seek(offset)
+      while True:
+         header = self.file.read(RECORD.size)
+         if len(header) < RECORD.size: return
+         t, length = RECORD.unpack(header)
+         offset += RECORD.size
+         yield t, offset, length
+         offset += length
+         self.file.seek(offset)
+
+   def records(self, start=None, end=None):
+      """ yield ( timestamp, data ) of all records from start to end """
+      for t, offset, length in list(self.index()):
+         if start is not None and t < start: continue
+         if end is not None and t > end: return
+         self.file.seek(offset)
+         yield t, self.file.read(length)
+
+   def tail(self, max_bytes):
+      """ return the data of the most recent records, at most max_bytes """
+      index = list(self.index())
+      size = 0
+      first = len(index)
+      while first > 0 and size + index[first-1][2] <= max_bytes:
+         first -= 1
+         size += index[first][2]
+      data = bytearray()
+      for t, offset, length in index[first:]:
+         self.file.seek(offset)
+         data.extend(self.file.read(length))
+      return bytes(data)
+
+   def grep(self, pattern):
+      """ yield ( timestamp, line ) of all lines matching a compiled bytes
+      regex. The timestamp is the one of the record the line ends in """
+      line = bytearray()
+      for t, data in self.records():
+         parts = data.split(b"\n")
+         for part in parts[:-1]:
+            line.extend(part)
+            if pattern.search(line): yield t, bytes(line).rstrip(b"\r")
+            line = bytearray()
+         line.extend(parts[-1])
+      if line and pattern.search(line):
+         yield t, bytes(line).rstrip(b"\r")
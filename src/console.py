@@ -16,14 +16,135 @@
 # Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
-import sys, os
+import sys, os, time, re, codecs
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 
+# the 16 basic colors as used by xterm
+ANSI_COLORS = [ 0x000000, 0xcd0000, 0x00cd00, 0xcdcd00, 0x0000ee, 0xcd00cd, 0x00cdcd, 0xe5e5e5,
+                0x7f7f7f, 0xff0000, 0x00ff00, 0xffff00, 0x5c5cff, 0xff00ff, 0x00ffff, 0xffffff ]
+
+def ansi_color(index):
+    """ return the color of an entry of the 256 color palette """
+    if index < 16:
+        return QColor(ANSI_COLORS[index])
+    if index < 232:
+        # 6x6x6 color cube
+        index -= 16
+        steps = [ 0, 95, 135, 175, 215, 255 ]
+        return QColor(steps[index // 36], steps[index // 6 % 6], steps[index % 6])
+    # grayscale ramp
+    level = 8 + 10 * (min(index, 255) - 232)
+    return QColor(level, level, level)
+
+class VTParser(object):
+    """ Incremental parser for the output of a VT100/ANSI terminal, following
+    the state machine of a DEC VT. The transitions are looked up in a table
+    per state. Text is passed on in runs, sequences may be split over several
+    calls of feed(). The screen gets vt_print(text), vt_execute(ctrl),
+    vt_esc(intermediates, final) and vt_csi(params, private, final) """
+
+    GROUND, ESCAPE, ESCAPE_INTERMEDIATE, CSI_ENTRY, CSI_PARAM, \
+        CSI_INTERMEDIATE, CSI_IGNORE, OSC_STRING = range(8)
+
+    # runs of printable characters are handled in one go
+    TEXT = re.compile("[^\x00-\x1f\x7f]+")
+
+    def __init__(self, screen):
+        self.screen = screen
+        self.state = VTParser.GROUND
+        self.clear()
+
+        # transitions are ( action, next state ) tuples per character.
+        # Characters not in the table are ignored by default
+        T = VTParser
+        c0 = [ chr(c) for c in range(0x18) ] + [ "\x19" ] + [ chr(c) for c in range(0x1c, 0x20) ]
+        chars = lambda a, b: [ chr(c) for c in range(a, b + 1) ]
+        self.table = [ { } for i in range(8) ]
+        self.default = [ ( self.ignore, s ) for s in range(8) ]
+        self.default[T.GROUND] = ( self.print, T.GROUND )
+        def add(states, keys, action, state=None):
+            for s in states:
+                for k in keys:
+                    self.table[s][k] = ( action, s if state is None else state )
+
+        every = range(8)
+        add(every, c0, self.execute)
+        add(every, [ "\x18", "\x1a" ], self.execute, T.GROUND)
+        add(every, [ "\x1b" ], self.clear, T.ESCAPE)
+        add(every, [ "\x7f" ], self.ignore)
+        add([ T.OSC_STRING ], c0, self.ignore)
+        add([ T.OSC_STRING ], [ "\x07" ], self.ignore, T.GROUND)
+        add([ T.ESCAPE ], chars(0x20, 0x2f), self.collect, T.ESCAPE_INTERMEDIATE)
+        add([ T.ESCAPE ], chars(0x30, 0x7e), self.esc_dispatch, T.GROUND)
+        add([ T.ESCAPE ], [ "[" ], self.clear, T.CSI_ENTRY)
+        add([ T.ESCAPE ], [ "]" ], self.ignore, T.OSC_STRING)
+        add([ T.ESCAPE_INTERMEDIATE ], chars(0x20, 0x2f), self.collect)
+        add([ T.ESCAPE_INTERMEDIATE ], chars(0x30, 0x7e), self.esc_dispatch, T.GROUND)
+        add([ T.CSI_ENTRY, T.CSI_PARAM ], chars(0x30, 0x39) + [ ";" ], self.param, T.CSI_PARAM)
+        add([ T.CSI_ENTRY ], chars(0x3c, 0x3f), self.collect, T.CSI_PARAM)
+        add([ T.CSI_ENTRY ], [ ":" ], self.ignore, T.CSI_IGNORE)
+        add([ T.CSI_PARAM ], [ ":" ] + chars(0x3c, 0x3f), self.ignore, T.CSI_IGNORE)
+        add([ T.CSI_ENTRY, T.CSI_PARAM, T.CSI_INTERMEDIATE ], chars(0x20, 0x2f), self.collect, T.CSI_INTERMEDIATE)
+        add([ T.CSI_INTERMEDIATE ], chars(0x30, 0x3f), self.ignore, T.CSI_IGNORE)
+        add([ T.CSI_ENTRY, T.CSI_PARAM, T.CSI_INTERMEDIATE ], chars(0x40, 0x7e), self.csi_dispatch, T.GROUND)
+        add([ T.CSI_IGNORE ], chars(0x40, 0x7e), self.ignore, T.GROUND)
+
+    def feed(self, data):
+        i, n = 0, len(data)
+        while i < n:
+            if self.state == VTParser.GROUND:
+                m = VTParser.TEXT.match(data, i)
+                if m:
+                    self.screen.vt_print(m.group())
+                    i = m.end()
+                    continue
+
+            c = data[i]
+            i += 1
+            action, self.state = self.table[self.state].get(c, self.default[self.state])
+            action(c)
+
+    def ignore(self, c):
+        pass
+
+    def print(self, c):
+        self.screen.vt_print(c)
+
+    def execute(self, c):
+        self.screen.vt_execute(c)
+
+    def clear(self, c=None):
+        self.params = ""
+        self.intermediates = ""
+
+    def collect(self, c):
+        self.intermediates += c
+
+    def param(self, c):
+        self.params += c
+
+    def esc_dispatch(self, c):
+        self.screen.vt_esc(self.intermediates, c)
+
+    def csi_dispatch(self, c):
+        # missing parameters are None
+        params = [ int(p) if p else None for p in self.params.split(";") ] if self.params else [ ]
+        self.screen.vt_csi(params, self.intermediates, c)
+
 class Console(QPlainTextEdit):
     input = pyqtSignal(str)
     interact = pyqtSignal(bool)
+    capture = pyqtSignal(bool)
+    replay = pyqtSignal()
+    plot = pyqtSignal(bool)
+
+    # number of lines kept by default. The oldest lines are dropped
+    MAX_LINES = 10000
+
+    # output arriving from the board is rendered at most once per FRAME ms
+    FRAME = 30
     
     def __init__(self):
         super().__init__()
@@ -31,14 +152,35 @@ class Console(QPlainTextEdit):
         self.setLineWrapMode(QPlainTextEdit.LineWrapMode.NoWrap)
         self.setReadOnly(True)
         self.input_enabled = False
+
+        # the document is bounded and doesn't keep an undo history
+        self.setMaximumBlockCount(Console.MAX_LINES)
+        self.setUndoRedoEnabled(False)
+
+        # output is collected and rendered in one go, all changes are
+        # done through a single cursor within one edit block
+        self.pending = bytearray()
+        self.render_timer = QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.timeout.connect(self.render)
+        self.cursor = None
+        self.editing = 0
+        self.rendered = 0
         
         font = QFont("Mono", 10)
         font.setStyleHint(QFont.Monospace);
         font.setFixedPitch(True)
         self.setFont(font)
 
-        self.buffer = b""
-        self.esc_buffer = ""
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        # terminal state
+        self.parser = VTParser(self)
+        self.tf = None       # default character format
+        self.fmt = None      # format for the current rendition, if known
+        self.color = None    # color of text not coming from the board
+        self.fg = self.bg = None
+        self.bold = self.italic = self.underline = self.reverse = False
 
         # overlay prompt button
         self.btn_prompt = QPushButton(self)
@@ -51,6 +193,22 @@ class Console(QPlainTextEdit):
         self.interactive = False
 
         self.savedCursor = None
+        self.capturing = False
+        self.plotting = False
+
+    def contextMenuEvent(self, event):
+        menu = self.createStandardContextMenu()
+        menu.addSeparator()
+        captureAction = menu.addAction(self.tr("Capture to file..."))
+        captureAction.setCheckable(True)
+        captureAction.setChecked(self.capturing)
+        captureAction.triggered.connect(self.capture)
+        menu.addAction(self.tr("Replay capture..."), self.replay.emit)
+        plotAction = menu.addAction(self.tr("Plot numeric output"))
+        plotAction.setCheckable(True)
+        plotAction.setChecked(self.plotting)
+        plotAction.triggered.connect(self.plot)
+        menu.exec_(event.globalPos())
 
     def insertFromMimeData(self, mimedata):
         # make sure pasted text goes through the device
@@ -115,90 +273,210 @@ class Console(QPlainTextEdit):
                 # print("text:", key)
                 self.input.emit(key)
 
-    def setText(self, str, tf):
-        # delete as many characters as would be inserted to
-        # implement some overwrite
-        cursor = self.textCursor()
-        cursor.movePosition(QTextCursor.Right, QTextCursor.KeepAnchor, len(str))
-        cursor.removeSelectedText()
-        cursor.insertText(str, tf);
-                
+    def set_max_lines(self, lines):
+        self.setMaximumBlockCount(lines)
+
+    def clear(self):
+        self.pending = bytearray()
+        self.decoder.reset()
+        self.render_timer.stop()
+        super().clear()
+
+    def begin(self):
+        # start a batch of changes
+        if self.editing == 0:
+            self.cursor = self.textCursor()
+            self.cursor.beginEditBlock()
+        self.editing += 1
+
+    def end(self):
+        # finish a batch of changes. The view is only updated once
+        self.editing -= 1
+        if self.editing == 0:
+            self.cursor.endEditBlock()
+            self.setTextCursor(self.cursor)
+            self.cursor = None
+            self.ensureCursorVisible()
+
     def appendFinal(self, str, color):
         # append directly without any further processing
-        if not hasattr(self, 'tf') or not self.tf:
-            self.tf = self.currentCharFormat()
-        if color:
-            tf = self.currentCharFormat()
-            tf.setForeground(QBrush(QColor(color)))
-            self.setText(str, tf)
-        else:
-            self.setText(str, self.tf)
-        self.ensureCursorVisible()
-
-    def appendWithCR(self, str, color):
-        # check for return in string and go to end of line first
-        # so no linebreak is inserted
-        if "\n" in str:
-            parts = str.split("\n")
-            self.appendWithBS(parts[0], color)
-            for i in range(1, len(parts)):
-                # jump to end of line
-                cursor = self.textCursor()
-                cursor.movePosition(QTextCursor.EndOfLine, QTextCursor.MoveAnchor)
-                self.setTextCursor(cursor)
-                
-                self.appendWithBS("\n" + parts[i], color)
-        else:
-            self.appendWithBS(str, color)
-        
-    def appendWithBS(self, str, color):
+        self.render()
+        self.begin()
+        self.color = color
+        lines = str.split("\n")
+        for i, line in enumerate(lines):
+            if i: self.vt_execute("\n")
+            if line: self.vt_print(line)
+        self.color = None
+        self.end()
+
+    def format(self):
+        # the character format for the current graphic rendition
+        if self.fmt is None:
+            if self.tf is None:
+                self.tf = self.currentCharFormat()
+            fmt = QTextCharFormat(self.tf)
+            fg, bg = self.fg, self.bg
+            if self.reverse:
+                fg, bg = bg or self.palette().color(QPalette.Base), fg or self.palette().color(QPalette.Text)
+            if fg is not None: fmt.setForeground(QBrush(fg))
+            if bg is not None: fmt.setBackground(QBrush(bg))
+            if self.bold: fmt.setFontWeight(QFont.Bold)
+            fmt.setFontItalic(self.italic)
+            fmt.setFontUnderline(self.underline)
+            self.fmt = fmt
+
+        if self.color:
+            fmt = QTextCharFormat(self.fmt)
+            fmt.setForeground(QBrush(QColor(self.color)))
+            return fmt
+        return self.fmt
+
+    def column(self, col):
+        # move to a column of the current line, pad it with spaces if
+        # it's too short
+        c = self.cursor
+        c.movePosition(QTextCursor.StartOfBlock)
+        length = c.block().length() - 1
+        c.movePosition(QTextCursor.Right, QTextCursor.MoveAnchor, min(col, length))
+        if col > length: c.insertText(" " * (col - length), self.tf or self.currentCharFormat())
+
+    def top(self):
+        # the number of the first line of the visible screen
+        rows = max(1, self.viewport().height() // max(1, self.fontMetrics().lineSpacing()))
+        return max(0, self.document().blockCount() - rows)
+
+    def row(self, delta):
+        # move up or down keeping the column. Moving down doesn't go
+        # beyond the last line
+        c = self.cursor
+        col = c.positionInBlock()
+        op = QTextCursor.PreviousBlock if delta < 0 else QTextCursor.NextBlock
+        for i in range(abs(delta)):
+            if not c.movePosition(op): break
+        self.column(col)
+
+    def vt_print(self, text):
+        # overwrite the rest of the line. There's nothing to overwrite
+        # at the end of the line
+        c = self.cursor
+        if not c.atBlockEnd():
+            left = c.block().length() - 1 - c.positionInBlock()
+            c.movePosition(QTextCursor.Right, QTextCursor.KeepAnchor, min(len(text), left))
+        c.insertText(text, self.format())
+
+    def vt_execute(self, ctrl):
+        c = self.cursor
+        if ctrl == "\n":
+            # a new line is only started at the end of the output
+            if not c.movePosition(QTextCursor.NextBlock):
+                c.movePosition(QTextCursor.EndOfBlock)
+                c.insertText("\n")
+        elif ctrl == "\r":
+            c.movePosition(QTextCursor.StartOfBlock)
+        elif ctrl == "\x08":
+            if c.positionInBlock() > 0: c.movePosition(QTextCursor.Left)
+        elif ctrl == "\t":
+            self.vt_print(" " * (8 - c.positionInBlock() % 8))
+        # everything else incl. micropython's \x04 is ignored
+
+    def vt_esc(self, intermediates, final):
+        pass   # no escape sequences without CSI are supported
+
+    def vt_csi(self, params, private, final):
+        if private: return   # e.g. showing or hiding the cursor
         
-        # process backspace
-        if "\x08" in str:
-            parts = str.split("\x08")
-            self.appendFinal(parts[0], color)
-            for i in range(len(parts)-1):
-                # here is a BS
-                cursor = self.textCursor()
-                cursor.movePosition(QTextCursor.Left, QTextCursor.MoveAnchor)
-                self.setTextCursor(cursor)
-            
-                # self.textCursor().deletePreviousChar()
-                self.appendFinal(parts[i+1], color)
-        else:
-            self.appendFinal(str, color)
-
-    def unEsc(self, str):
-        if len(str) < 1: return None  # not enough data to decode
-        if str[0] != "[": return str  # not a [ -> just print
-        if len(str) < 2: return None  # not enough data to decode
-
-        # a complete esc sequence consists of ESC[<num><char>
-        # parse <num> if present
-        i = 1
-        num = None
-        while i < len(str) and str[i].isdigit():
-            if num == None: num = 0
-            num = (num * 10) + int(str[i])
-            i = i + 1
-
-        # no more chars after number
-        if i >= len(str): return None
-            
-        if str[i] == 'K':
-            cursor = self.textCursor()
-            cursor.movePosition(QTextCursor.EndOfLine, QTextCursor.KeepAnchor)
-            cursor.removeSelectedText()
-            self.setTextCursor(cursor)
-        elif str[i] == 'D':
-            if num is None: num = 1
-            cursor = self.textCursor()
-            cursor.movePosition(QTextCursor.Left, QTextCursor.MoveAnchor, num)
-            self.setTextCursor(cursor)
-        else:
-            print(">>>>>>>>>>>>>>> unsupported ESC", str[i], num)
-            
-        return str[i+1:]
+        c = self.cursor
+        n = params[0] if params and params[0] else 1
+        if final == "m":
+            self.sgr(params)
+        elif final == "A":
+            self.row(-n)
+        elif final == "B":
+            self.row(n)
+        elif final == "C":
+            self.column(c.positionInBlock() + n)
+        elif final == "D":
+            self.column(max(0, c.positionInBlock() - n))
+        elif final == "G":
+            self.column(n - 1)
+        elif final in "Hf":
+            # rows are counted from the top of the visible screen
+            row = self.top() + n - 1
+            while self.document().blockCount() <= row:
+                c.movePosition(QTextCursor.End)
+                c.insertText("\n")
+            c.setPosition(self.document().findBlockByNumber(row).position())
+            self.column((params[1] if len(params) > 1 and params[1] else 1) - 1)
+        elif final == "J":
+            mode = params[0] or 0 if params else 0
+            if mode == 0:
+                c.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+                c.removeSelectedText()
+            elif mode == 1:
+                # the lines from the top of the screen are emptied and
+                # the current line is blanked up to the cursor
+                col = c.positionInBlock()
+                block = c.blockNumber()
+                top = min(self.top(), block)
+                c.setPosition(self.document().findBlockByNumber(top).position())
+                c.setPosition(self.document().findBlockByNumber(block).position(), QTextCursor.KeepAnchor)
+                c.insertText("\n" * (block - top))
+                self.column(col)
+                self.vt_csi([ 1 ], private, "K")
+            elif mode >= 2:
+                c.select(QTextCursor.Document)
+                c.removeSelectedText()
+        elif final == "K":
+            mode = params[0] or 0 if params else 0
+            col = c.positionInBlock()
+            if mode == 0:
+                c.movePosition(QTextCursor.EndOfBlock, QTextCursor.KeepAnchor)
+                c.removeSelectedText()
+            else:
+                # the line up to the cursor or all of it is blanked
+                c.movePosition(QTextCursor.StartOfBlock)
+                c.movePosition(QTextCursor.EndOfBlock if mode == 2 else QTextCursor.Right,
+                               QTextCursor.KeepAnchor, 1 if mode == 2 else col)
+                c.insertText(" " * (c.selectionEnd() - c.selectionStart()), self.tf or self.currentCharFormat())
+                self.column(col)
+
+    def sgr(self, params):
+        # select graphic rendition, colors and attributes
+        if not params: params = [ 0 ]
+        i = 0
+        while i < len(params):
+            p = params[i]
+            if p is None or p == 0:
+                self.fg = self.bg = None
+                self.bold = self.italic = self.underline = self.reverse = False
+            elif p == 1:             self.bold = True
+            elif p == 3:             self.italic = True
+            elif p == 4:             self.underline = True
+            elif p == 7:             self.reverse = True
+            elif p == 22:            self.bold = False
+            elif p == 23:            self.italic = False
+            elif p == 24:            self.underline = False
+            elif p == 27:            self.reverse = False
+            elif 30 <= p <= 37:      self.fg = ansi_color(p - 30)
+            elif p == 39:            self.fg = None
+            elif 40 <= p <= 47:      self.bg = ansi_color(p - 40)
+            elif p == 49:            self.bg = None
+            elif 90 <= p <= 97:      self.fg = ansi_color(p - 90 + 8)
+            elif 100 <= p <= 107:    self.bg = ansi_color(p - 100 + 8)
+            elif p in (38, 48):
+                # extended colors, 256 color palette or rgb
+                color = None
+                if i + 2 < len(params) and params[i+1] == 5:
+                    color = ansi_color(params[i+2] or 0)
+                    i += 2
+                elif i + 4 < len(params) and params[i+1] == 2:
+                    color = QColor(*[ min(255, v or 0) for v in params[i+2:i+5] ])
+                    i += 4
+                if p == 38: self.fg = color
+                else:       self.bg = color
+            i += 1
+        self.fmt = None
 
 #    def mouseDoubleClickEvent(self, event):
 #        print("suppressing mouse double click event")
@@ -209,85 +487,45 @@ class Console(QPlainTextEdit):
 #    def mousePressEvent(self, event):
 #        print("suppressing mouse press event")
 
-    def append(self, str, color=None):        
-        # prepend and incomplete esc sequence we may still have
-        if self.esc_buffer is not None:
-            str = self.esc_buffer + str
-            self.esc_buffer = None
-
-        # check if there are escape sequences in the string
-        if "\033" in str:        
-            strparts = str.split("\033")
-
-            # output everything before first esc
-            if len(strparts[0]) > 0:
-                # part before ESC
-                self.appendWithCR(strparts[0], color)
-
-            # there are "middle parts"
-            if len(strparts) > 2:
-                # process everything but the last one directly
-                for i in range(len(strparts)-2):
-                    d = self.unEsc(strparts[1+i])
-                    if d is not None:
-                        self.appendWithCR(d, color)
-
-            # and the rest may potentially be incomplete (yet) ...
-            d = self.unEsc(strparts[-1])
-            # whole ESC sequence could be removed
-            if d is not None:
-                self.appendWithCR(d, color)
-            else:
-                # store incomplete esc sequence
-                self.esc_buffer = "\033" + strparts[-1]
-        else:
-            self.appendWithCR(str, color)
+    def append(self, str, color=None):
+        # pending output from the board goes first
+        self.render()
+        self.begin()
+        self.write(str, color)
+        self.end()
+
+    def write(self, str, color=None):
+        # escape sequences may be split over several writes, the parser
+        # keeps its state in between
+        self.color = color
+        self.parser.feed(str)
+        self.color = None
             
     def appendBytes(self, b):
-        # prepend everything we might still have in buffer
-        if len(self.buffer) > 0:
-            b = self.buffer + b
-            self.buffer = b""
+        # collect everything arriving until the next frame. Output
+        # arriving after a pause is shown immediately, e.g. echoed keys
+        self.pending.extend(b)
+        if not self.render_timer.isActive():
+            wait = self.rendered + Console.FRAME / 1000 - time.monotonic()
+            if wait > 0: self.render_timer.start(int(1000 * wait) + 1)
+            else:        self.render()
 
-        if len(b) == 0: return
+    def render(self):
+        self.render_timer.stop()
+        if not self.pending: return
+        b, self.pending = self.pending, bytearray()
+        self.rendered = time.monotonic()
 
         # the user may have moved the cursor using the mouse. Undo
         # that and restore the cursor position micropython expects
         if self.savedCursor:
             self.setTextCursor(self.savedCursor)
             self.savedCursor = None
-        
-        # try to decode bytes
-        try:
-            # this callback receives single bytes or bytearrays
-            # it may happen that e.g. a utf-8 character is on the
-            # "border". This causes an decoding exception and the
-            # incomplete undecoded part is stored until more data
-            # has arrived.
-            msg = b.decode("utf-8")
-            msg = msg.replace('\r', '').replace('\x04', '')  # filter out \r and \x04
-            self.append(msg)
-        except Exception as e:
-            # decoding failed, probably since the contents isn't valid utf-8
-            print("Console decoding failed #1", str(e))
-
-            # Check if the message can be decoded without the last character.
-            try:
-                msg = b[:-1].decode("utf-8")
-                msg = msg.replace('\r', '').replace('\x04', '')  # filter out \r and \x04
-                self.append(msg)
-                
-                self.buffer = b[-1]  # keep last byte in buffer
-            except Exception as e:
-                print("Console decoding failed #2", str(e))
-                # if that also fails, decode as ascii
-                try:                    
-                    msg = b.decode("iso-8859-1")
-                    msg = msg.replace('\r', '').replace('\x04', '')  # filter out \r and \x04
-                    self.append(msg)
-                except Exception as e:
-                    # and finally ignore everything ...
-                    print("Console decoding finally failed", str(e))
+
+        # a utf-8 character may be split over two chunks. The decoder
+        # keeps the incomplete part until the rest has arrived. Invalid
+        # data is shown as replacement character
+        self.append(self.decoder.decode(b))
 
         # save cursor
         self.savedCursor = self.textCursor()
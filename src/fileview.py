@@ -16,7 +16,7 @@
 # Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
-import os, sys
+import os, sys, bisect
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 from PyQt5.QtCore import *
@@ -28,15 +28,14 @@ class FileNode(object):
    def __init__(self, name, size = None): 
       self.name = name
       self.size = size
+      # children are kept sorted by name, _names mirrors their names so
+      # rows can be found by bisection
       self._children = []
+      self._names = []
       self._parent = None
-      self._row = 0
-      
-   def copy(self):
-      d = FileNode(self.name, self.size)
-      d._children = self._children
-      d._parent = self._parent
-      return d
+      # directory contents are known (True), being fetched from
+      # the board (False) or not fetched yet (None)
+      self.listed = True
       
    def path(self):
       # check number of parents as we want to ignore the
@@ -58,23 +57,6 @@ class FileNode(object):
       elif column == FileView.COL_SIZE: return self.size;
       return None
 
-   def set(self, node):
-      # overwrite an entry with a different one (e.g. while renaming)
-      # the _row field is not changed and should already be correct as
-      # well as the _parent field
-      self.name = node.name
-      self.size = node.size
-      self._children = node._children
-      # adjust parent entries of all children
-      for c in self._children:
-         c._parent = self
-      
-   def setData(self, column, data):      
-      if column == FileView.COL_NAME:
-         self.name = data
-      elif column == FileView.COL_SIZE:
-         self.size = data
-
    def isDir(self):
       return self.size is None
          
@@ -92,36 +74,60 @@ class FileNode(object):
       return self._parent
 
    def row(self):
-      return self._row
+      if not self._parent:
+         return 0
+      return bisect.bisect_left(self._parent._names, self.name)
 
    def addChild(self, child):
+      # append a child that sorts behind all existing ones
       child._parent = self
-      child._row = len(self._children)
       self._children.append(child)
+      self._names.append(child.name)
 
-   def insertChild(self, row, child):
+   def insertChild(self, child):
+      # insert a child at its sorted position and return its row
+      row = bisect.bisect_right(self._names, child.name)
       child._parent = self
-      child._row = None
       self._children.insert(row, child)
-
-      # renumber all children from new one up
-      for i in range(row, len(self._children)):
-         self._children[i]._row = i
+      self._names.insert(row, child.name)
+      return row
          
    def removeChild(self, row):
-      self._children.remove(self._children[row])
-      # renumber all children afterwards
-      for i in range(row, len(self._children)):
-         self._children[i]._row = i
+      child = self._children.pop(row)
+      del self._names[row]
+      child._parent = None
+      return child
       
    def __str__(self):
       return "FileNode {}({}) kids: {}".format(self.name, self.size, self.childCount());
       
 class FileModel(QAbstractItemModel):
+   fetch = pyqtSignal(str)   # contents of a directory are to be fetched from the board
+   
    def __init__(self, nodes):
       super().__init__()
       self._root = nodes
 
+      # all nodes below the invisible root by path and the number
+      # of regular files among them
+      self._paths = { }
+      self._files = 0
+      for child in nodes._children:
+         self._index(child)
+
+   def _index(self, node):
+      # add a node and everything below it to the path index
+      self._paths[node.path()] = node
+      if not node.isDir(): self._files += 1
+      for child in node._children:
+         self._index(child)
+
+   def _unindex(self, node):
+      self._paths.pop(node.path(), None)
+      if not node.isDir(): self._files -= 1
+      for child in node._children:
+         self._unindex(child)
+
       # Translate asset paths to useable format for PyInstaller
    def resource_path(self, relative_path):
       if hasattr(sys, '_MEIPASS'):
@@ -138,19 +144,126 @@ class FileModel(QAbstractItemModel):
          return self._root
       else:
          return index.internalPointer()      
+
+   def nodeIndex(self, node):
+      if node is self._root:
+         return QModelIndex()
+      return QAbstractItemModel.createIndex(self, node.row(), 0, node)
+
+   def appendNodes(self, parent, nodes):
+      # add several nodes to the children of parent. They are inserted
+      # in one go if they all sort behind the existing children, which
+      # is the case for filesystems listing their directories in order
+      nodes.sort(key = lambda n: n.name)
+      if parent._names and nodes[0].name <= parent._names[-1]:
+         for node in nodes:
+            self.insertNode(parent, node)
+         return
+      
+      row = parent.childCount()
+      self.beginInsertRows(self.nodeIndex(parent), row, row+len(nodes)-1)
+      for node in nodes:
+         parent.addChild(node)
+         self._index(node)
+      self.endInsertRows()
    
-   def insertRows(self, row, count, _parent=QModelIndex()):
-      self.beginInsertRows(_parent, row, row+count-1)
-      for i in range(count):
-         self.getNode(_parent).insertChild(row+i, FileNode(None) )
-      self.endInsertRows();
-      return True
-   
+   def findNode(self, path):
+      return self._paths.get(path)
+
+   def numberOfFiles(self):
+      return self._files
+
+   def insertNode(self, parent, node):
+      # insert a new node (and its children) at its sorted position
+      row = bisect.bisect_right(parent._names, node.name)
+      self.beginInsertRows(self.nodeIndex(parent), row, row)
+      parent.insertChild(node)
+      self._index(node)
+      self.endInsertRows()
+      
+   def removeNode(self, node):
+      row = node.row()
+      self.beginRemoveRows(self.nodeIndex(node._parent), row, row)
+      self._unindex(node)
+      node._parent.removeChild(row)
+      self.endRemoveRows()
+
+   def moveNode(self, node, parent, name):
+      # rename a node and/or move it into another directory. Its
+      # children move with it
+      self.removeNode(node)
+      node.name = name
+      self.insertNode(parent, node)
+
+   def clearNode(self, node):
+      # remove all children of a directory and mark it as unlisted
+      if node.childCount():
+         self.beginRemoveRows(self.nodeIndex(node), 0, node.childCount()-1)
+         for child in node._children:
+            self._unindex(child)
+            child._parent = None
+         node._children = []
+         node._names = []
+         self.endRemoveRows()
+      node.listed = None
+
+   def setListed(self, node, recursive = False):
+      node.listed = True
+      if recursive:
+         for child in node._children:
+            if child.isDir(): self.setListed(child, True)
+
+   def resetListed(self):
+      # pending fetches won't complete, fetch them again when needed
+      for node in self._paths.values():
+         if node.listed is False: node.listed = None
+         
+   def hasChildren(self, index = QModelIndex()):
+      # unlisted directories may have children
+      node = self.getNode(index)
+      if node.isDir() and node.listed is None:
+         return True
+      return node.childCount() > 0
+
+   def canFetchMore(self, index):
+      node = self.getNode(index)
+      return node.isDir() and node.listed is None
+
+   def fetchMore(self, index):
+      node = self.getNode(index)
+      node.listed = False
+      self.fetch.emit(node.path())
+
+   def setSize(self, node, size):
+      if node.isDir() != (size is None):
+         self._files += 1 if node.isDir() else -1
+      node.size = size
+      index = self.nodeIndex(node)
+      self.dataChanged.emit(index, index.siblingAtColumn(FileView.COL_SIZE))
+
+   def nextFile(self, path = None):
+      # return the path of the first file following path in the order
+      # the tree is displayed or the very first file if no path is given
+      node = self._paths.get("" if path is None else path)
+      while node is not None:
+         if node._children:
+            node = node._children[0]
+         else:
+            # no children, continue with the next sibling of this
+            # node or of the nearest parent that has one
+            while node._parent is not None and node.row() + 1 >= node._parent.childCount():
+               node = node._parent
+            node = node._parent.child(node.row() + 1) if node._parent else None
+
+         if node is not None and not node.isDir():
+            return node.path()
+
+      return None
+
    def removeRows(self, row, count, _parent=QModelIndex()):
-      self.beginRemoveRows(_parent, row, row+count-1);
+      parent = self.getNode(_parent)
       for i in range(count):
-         self.getNode(_parent).removeChild(row+i)
-      self.endRemoveRows()
+         self.removeNode(parent.child(row))
       return True
 
    def rowCount(self, index):
@@ -191,17 +304,6 @@ class FileModel(QAbstractItemModel):
 
       return index.internalPointer().path()
 
-   def setData(self, index, value, role):
-      if not index.isValid():
-         return False
-
-      if role == Qt.DisplayRole:
-         self.getNode(index).setData(index.column(), value)
-         self.dataChanged.emit(index, index)
-         return True
-
-      return False
-         
    def data(self, index, role):
       if not index.isValid():
          return None
@@ -267,7 +369,8 @@ class FileView(QTreeView):
    delete = pyqtSignal(str)   
    rename = pyqtSignal(str, str)   
    firmware = pyqtSignal()
-   refresh = pyqtSignal()
+   refresh = pyqtSignal(str)
+   fetch = pyqtSignal(str)
    host_import = pyqtSignal(str, str)
    example_import = pyqtSignal(str, dict)
    example_imported = pyqtSignal(str, bytes, dict)
@@ -275,6 +378,9 @@ class FileView(QTreeView):
    selection_changed = pyqtSignal(str)
    backup = pyqtSignal()
    restore = pyqtSignal()
+   sync = pyqtSignal()
+   watch = pyqtSignal(bool)
+   compile = pyqtSignal(bool)
    file_import = pyqtSignal(str)
    file_export = pyqtSignal(str, int)
    
@@ -300,6 +406,17 @@ class FileView(QTreeView):
       self.restoreAction = QAction(self.tr("Restore..."), self.backupMenu);
       self.restoreAction.triggered.connect(self.on_context_restore)
       self.backupMenu.addAction(self.restoreAction);
+      self.syncAction = QAction(self.tr("Sync folder..."), self.contextMenu);
+      self.syncAction.triggered.connect(self.on_context_sync)
+      self.contextMenu.addAction(self.syncAction);
+      self.watchAction = QAction(self.tr("Auto upload..."), self.contextMenu);
+      self.watchAction.setCheckable(True)
+      self.watchAction.triggered.connect(self.watch)
+      self.contextMenu.addAction(self.watchAction);
+      self.compileAction = QAction(self.tr("Compile with mpy-cross"), self.contextMenu);
+      self.compileAction.setCheckable(True)
+      self.compileAction.triggered.connect(self.compile)
+      self.contextMenu.addAction(self.compileAction);
       self.newMenu = self.contextMenu.addMenu(self.tr("New"))      
       self.newAction = QAction(self.tr("File..."), self.newMenu);
       self.newAction.triggered.connect(self.on_context_new)
@@ -432,50 +549,22 @@ class FileView(QTreeView):
    
       return files
          
-   def findNode(self, name, path = "", node = None):
-      if node is None:
-         node = self.model()._root.child(0)
-
-      for ci in range(node.childCount()):
-         child = node.child(ci)
-         if name.startswith(path+"/"+child.name+"/"):
-            return self.findNode(name, path+"/"+child.name, child)
-
-         if name == path+"/"+child.name:
-            return child   
-
-      return None
+   def findNode(self, name):
+      if self.model() is None: return None
+      return self.model().findNode(name)
             
    def exists(self, name):
       # check if a file with this name already exists
       return self.findNode(name) is not None
 
-   def expand_(self, model, name, parent = QModelIndex()):
-      for r in range(model.rowCount(parent)):
-         index = model.index(r, 0, parent);
-         lname = model.data(index, 0);
-         # check if this is the directory we are searching for
-         if len(name) > 0 and lname == name[0] and model.hasChildren(index):
-            self.expand(index)
-            if len(name) > 1:
-               self.expand_(model, name[1:], index)
-
    def expandPath(self, name):
-      self.expand_(self.model(), (self.rootname + name).split("/"))
+      # expand the root and all directories leading to name
+      parts = name.split("/")
+      for i in range(len(parts)):
+         node = self.findNode("/".join(parts[:i+1]))
+         if node is None or not node.childCount(): return
+         self.expand(self.model().nodeIndex(node))
 
-   # get modelindex for a named entry
-   def getIndex(self, model, name, parent = QModelIndex()):
-      for r in range(model.rowCount(parent)):
-         index = model.index(r, FileView.COL_NAME, parent);
-
-         if model.data(index, Qt.DisplayRole) == name[0]:
-            if len(name) == 1:
-               return index
-         
-            # check if we should enter this directory
-            if len(name) > 1 and model.hasChildren(index):
-               return self.getIndex(model, name[1:], index)
-               
    def isValidFilename(self, name):
       not_allowed = "\\/:*\"<>|"
       if name == "": return False
@@ -508,7 +597,9 @@ class FileView(QTreeView):
    def add_file_entry(self, name, size = -1):
       # check if entry already exists
       if not self.exists(name):
-         self.addToModel(self.model(), (self.rootname + name).split("/"), [ name.split("/")[-1], size ])      
+         parent = self.findNode(name.rsplit("/", 1)[0])
+         self.model().insertNode(parent, FileNode(name.split("/")[-1], size))
+         self.expand(self.model().nodeIndex(parent))
       
    def add_dir_entry(self, name):
       self.add_file_entry(name, None)
@@ -581,47 +672,25 @@ class FileView(QTreeView):
       self.file_export.emit(self.context_entry[0], self.context_entry[1])
       
    def on_context_refresh(self):
-      self.refresh.emit()
+      self.refresh.emit(self.context_entry[0])
 
    def on_context_firmware(self):
       self.firmware.emit()
 
-   def get_next_file(self, name = None, node = None, path = ""):
-      if node == None:
-         node = self.model()._root.child(0)
-         self.return_next_name = (name == None)         
-         
-      for ci in range(node.childCount()):
-         child = node.child(ci)
-         
-         # return first match if no name was given
-         if child.size != None and self.return_next_name:
-            return path+"/"+child.name
-         
-         if name == path+"/"+child.name:
-            self.return_next_name = True
-
-         # decent into subdirs
-         if child.size == None:
-            r = self.get_next_file(name, child, path+"/"+child.name)
-            if r != None: return r 
+   def get_next_file(self, name = None):
+      return self.model().nextFile(name)
 
-      return None
-
-   def number_of_files(self, node = None):
-      num = 0
-      if node == None: node = self.model()._root.child(0)
-      for ci in range(node.childCount()):
-         child = node.child(ci)
-         if child.size == None: num += self.number_of_files(child)
-         else:                  num += 1
-      return num
+   def number_of_files(self):
+      return self.model().numberOfFiles()
       
    def on_context_backup(self):
       self.backup.emit()
       
    def on_context_restore(self):
       self.restore.emit()
+
+   def on_context_sync(self):
+      self.sync.emit()
             
    def on_context_open(self):
       self.open.emit(self.context_entry[0], self.context_entry[1])
@@ -658,15 +727,9 @@ class FileView(QTreeView):
          self.message.emit(self.tr("A file with that name already exists"));
          return False
       
-      # get a copy of the old entry
-      entry = self.findNode(self.context_entry[0]).copy()
-
-      self.removeFromModel(self.model(), (self.rootname + self.context_entry[0]).split("/"))
-      self.addToModel(self.model(), (self.rootname + fullname).split("/"), [ name, 0 ])      
-
-      # update entry (so directories get their children back)
-      entry.name = name
-      self.findNode(fullname).set(entry)      
+      # move the entry to its new name, directories keep their children
+      node = self.findNode(self.context_entry[0])
+      self.model().moveNode(node, node.parent(), name)
 
       # keep selection on renamed object
       self.select(fullname)
@@ -674,64 +737,11 @@ class FileView(QTreeView):
       # and finally request the actual rename
       self.rename.emit(self.context_entry[0], fullname)
 
-   def store(self, model, parent, index, obj):
-      # create a new (unset) row
-      model.insertRow(index, parent)
-      # and set data in that row
-      model.setData(model.index(index, FileView.COL_NAME, parent),\
-                    obj[0], Qt.DisplayRole)
-      model.setData(model.index(index, FileView.COL_SIZE, parent),\
-                    obj[1], Qt.DisplayRole)
-      
-      self.expand(parent)
-               
-   def addToModel(self, model, name, obj, parent = QModelIndex()):
-      if len(name) == 1:
-         # iterate over all children to find the one to insert before
-         for r in range(model.rowCount(parent)):
-            index = model.index(r, FileView.COL_NAME, parent);
-            name = model.data(model.index(r, FileView.COL_NAME, parent), Qt.DisplayRole);
-
-            if name > obj[0]:
-               self.store(model, parent, r, obj)
-               return
-
-         # no item to insert before, so append
-         self.store(model, parent, model.rowCount(parent), obj)
-         return
-      else:         
-         # iterate over all children
-         for r in range(model.rowCount(parent)):
-            index = model.index(r, FileView.COL_NAME, parent);
-            size = model.data(model.index(r, FileView.COL_SIZE, parent), Qt.DisplayRole);
-
-            # check if we should enter this directory (size == None -> isdir)
-            # We cannot check with hasChildren here as we also want to
-            # handle empty directories
-            if model.data(index, Qt.DisplayRole) == name[0] and len(name) > 1 and size == None:
-               self.addToModel(model, name[1:], obj, index)        
-               
-   # remove item from model
-   def removeFromModel(self, model, name, parent = QModelIndex()):
-      for r in range(model.rowCount(parent)):
-         index = model.index(r, FileView.COL_NAME, parent);
-
-         if model.data(index, Qt.DisplayRole) == name[0]:
-            if len(name) == 1:
-               model.removeRow(r, parent)
-               return
-         
-            # check if we should enter this directory
-            if len(name) > 1 and model.hasChildren(index):
-               self.removeFromModel(model, name[1:], index)        
-
    def remove(self, fullname):
-      # get only the path
-      path = "/".join(fullname.split("/")[:-1])
-      name = fullname.split("/")[-1]
-            
       # Instead of updating the entire tree view just remove the row
-      self.removeFromModel(self.model(), (self.rootname + fullname).split("/"))
+      node = self.findNode(fullname)
+      if node is not None:
+         self.model().removeNode(node)
                
    def on_context_delete(self):
       qm = QMessageBox()
@@ -774,11 +784,14 @@ class FileView(QTreeView):
 
          self.setCurrentIndex(index)
       
-         # only the root entry has the firmware and refresh entries ...
-         self.refreshAction.setVisible(size == None and name == "")
+         # all directories can be refreshed, only the root entry has the firmware entry ...
+         self.refreshAction.setVisible(size == None)
          self.firmwareAction.setVisible(size == None and name == "")
          # ... and also the backup
          self.backupMenu.menuAction().setVisible(size == None and name == "")
+         self.syncAction.setVisible(size == None and name == "")
+         self.watchAction.setVisible(size == None and name == "")
+         self.compileAction.setVisible(size == None and name == "")
          
          # size is "None" for directories
 
@@ -820,67 +833,78 @@ class FileView(QTreeView):
                if self.is_editable(name):
                   self.open.emit(name, size)
                   
-   def updateModel(self, model, name, new_name, new_size, parent = QModelIndex()):
-      # and update entry in model
-      for r in range(model.rowCount(parent)):
-         index = model.index(r, FileView.COL_NAME, parent);
-         lname = model.data(index, Qt.DisplayRole);
-
-         if lname == name[0]:
-            if len(name) == 1:
-               # update size if requested ...
-               if new_size is not None:
-                  size_index = index.siblingAtColumn(FileView.COL_SIZE)
-                  model.setData(size_index, new_size, Qt.DisplayRole)
-               # ... or name
-               if new_name is not None:
-                  name_index = index.siblingAtColumn(FileView.COL_NAME)
-                  model.setData(name_index, new_name, Qt.DisplayRole)
-         
-            # check if we should enter this directory
-            if len(name) > 1 and model.hasChildren(index):
-               self.updateModel(model, name[1:], new_name, new_size, index)        
-                  
    def saved(self, name, size):
       # update size of entry in file list
       entry = self.findNode(name)
       if entry != None:
-         entry.size = size
-
-      self.updateModel(self.model(), (self.rootname + name).split("/"), None, size)      
+         self.model().setSize(entry, size)
                   
-   def getItems(self, files, path):
-      items = [ ]
-      for f in files:
-         filename = path + "/" + f[0]
-         if isinstance(f[1], int):
-            node = FileNode(f[0], f[1])
-         else:
-            node = FileNode(f[0])
-            for s in self.getItems(f[1], filename):
-               node.addChild(s)
-         items.append(node)
-      return items
-      
-   def set(self, files):
+   def set(self, entries):
       # invisible root item
       root = FileNode("")
 
-      if files != None:
-         rootdir = FileNode(self.rootname)
-         root.addChild(rootdir)
-         for i in self.getItems(files, ""):
-            rootdir.addChild(i)
+      if entries != None:
+         root.addChild(FileNode(self.rootname))
       
       model = FileModel(root)
+      model.fetch.connect(self.fetch)
       self.setModel(model)
       self.setItemDelegate(ItalicDelegate(self))
 
-      # expand root
-      self.expandPath("")
-
       self.selectionModel().selectionChanged.connect(self.onSelectionChanged)
 
+      if entries: self.add_entries(entries)
+
+   def add_entries(self, entries, recursive = True):
+      # add a batch of ( path, size, mtime ) records as received while
+      # the board is being listed. Directories are always reported
+      # before their contents, so the parent already exists. The
+      # entries of each parent are inserted in one go. Contents of
+      # directories only follow in recursive listings
+      groups = { }
+      for path, size, mtime in entries:
+         # entries may already have been added locally
+         if self.exists(path): continue
+         parent, name = path.rsplit("/", 1)
+         node = FileNode(name, size)
+         if node.isDir(): node.listed = False if recursive else None
+         groups.setdefault(parent, [ ]).append(node)
+
+      for parent, nodes in groups.items():
+         node = self.findNode(parent)
+         if node is not None:
+            self.model().appendNodes(node, nodes)
+
+      # an empty root cannot be expanded, so do that once it has children
+      if "" in groups: self.expandPath("")
+
+   def listing(self, path):
+      # a listing of the directory has been requested from the board
+      node = self.findNode(path)
+      if node is not None: node.listed = False
+
+   def listed(self, path, recursive = False):
+      # the listing of a directory has completed
+      node = self.findNode(path)
+      if node is not None: self.model().setListed(node, recursive)
+
+   def listing_failed(self):
+      if self.model() is not None: self.model().resetListed()
+
+   def is_listed(self, path):
+      node = self.findNode(path)
+      return node is not None and node.listed is True
+
+   def invalidate(self, path):
+      # forget the contents of a directory. They are fetched again
+      # right away if the directory is currently expanded
+      node = self.findNode(path)
+      if node is None or not node.isDir(): return
+      self.model().clearNode(node)
+      index = self.model().nodeIndex(node)
+      if self.isExpanded(index):
+         self.model().fetchMore(index)
+
    def onSelectionChanged(self, sel, desel):
       if len(sel.indexes()) > 0:
          index = sel.indexes()[0]
@@ -1014,26 +1038,25 @@ class FileView(QTreeView):
                self.message.emit(self.tr("A file or directory with that name already exists"));
                return
 
-            # get a copy of the old entry
-            entry = self.findNode(self.dragNode.path()).copy()         
-            self.removeFromModel(self.model(), (self.rootname + self.dragNode.path()).split("/"))
-            self.addToModel(self.model(), (self.rootname + fullname).split("/"), [ self.dragNode.name, 0 ])      
-
-            # update entry (so directories get their children back)
-            self.findNode(fullname).set(entry)      
+            # move the entry, directories keep their children
+            oldname = self.dragNode.path()
+            target = self.eventNode(event)
+            self.model().moveNode(self.dragNode, target, self.dragNode.name)
+            self.expand(self.model().nodeIndex(target))
 
             # keep selection on renamed object
             self.select(fullname)
 
             # and finally request the actual rename
-            self.rename.emit(self.dragNode.path(), fullname)
+            self.rename.emit(oldname, fullname)
 
    def select(self, fullname):
-      self.setCurrentIndex(self.getIndex(self.model(), (self.rootname + fullname).split("/")))
+      node = self.findNode(fullname)
+      if node is not None:
+         self.setCurrentIndex(self.model().nodeIndex(node))
             
    def add(self, fullname, length):
-      name = fullname.split("/")[-1]
       # add new file to tree
-      self.addToModel(self.model(), (self.rootname + fullname).split("/"), [ name, length ])
+      self.add_file_entry(fullname, length)
       # and select it
       self.select(fullname)
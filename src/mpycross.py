@@ -0,0 +1,150 @@
+#
+# mpycross.py
+#
+# Copyright (C) 2021 Till Harbaum <till@harbaum.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51 Franklin
+# Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os, shutil, subprocess, tempfile, hashlib, binascii, ast, itertools
+
+# the mpy-cross package from pypi brings its own binary
+try:
+   import mpy_cross
+except ImportError:
+   mpy_cross = None
+
+# architectures as encoded in bits 10.. of sys.implementation._mpy
+ARCHS = [ None, "x86", "x64", "armv6", "armv6m", "armv7m", "armv7em",
+          "armv7emsp", "armv7emdp", "xtensa", "xtensawin", "rv32imc" ]
+
+# a .mpy is run by importing it from a filesystem serving nothing but
+# that file. The module gets a new name for every run, so it's never taken
+# from sys.modules, and everything is cleaned up even if the code fails
+LOADER = """\
+try:
+ import binascii
+except ImportError:
+ import ubinascii as binascii
+import uos, uio, sys
+_upide_buf=binascii.a2b_base64('%(mpy)s')
+class _upide_fs:
+  class File(uio.IOBase):
+    def __init__(self):
+      self.off = 0
+    def ioctl(self, request, arg):
+      return 0
+    def readinto(self, buf):
+      buf[:] = memoryview(_upide_buf)[self.off:self.off + len(buf)]
+      self.off += len(buf)
+      return len(buf)
+  mount = umount = chdir = lambda *args: None
+  def stat(self, path):
+    if path.lstrip('/') == '%(name)s.mpy':
+      return tuple(0 for _ in range(10))
+    raise OSError(2)
+  def open(self, path, mode):
+    return self.File()
+try:
+  uos.umount('/_upide')
+except OSError:
+  pass
+uos.mount(_upide_fs(), '/_upide')
+sys.path.insert(0, '/_upide')
+try:
+  from %(name)s import *
+finally:
+  sys.path.remove('/_upide')
+  uos.umount('/_upide')
+  sys.modules.pop('%(name)s', None)
+  del _upide_buf, _upide_fs
+"""
+
+runs = itertools.count()
+
+def loader(mpy):
+   """ return code running the given .mpy when sent to the device """
+   return LOADER % { "mpy": binascii.b2a_base64(mpy, newline=False).decode("ascii"),
+                     "name": "_upide_run{}".format(next(runs)) }
+
+def uses_name(source):
+   """ check if the source refers to __name__. Imported code has its
+   module name there, so e.g. a __main__ check would fail """
+   try:
+      tree = ast.parse(source)
+   except (SyntaxError, ValueError):
+      return False
+   return any(isinstance(node, ast.Name) and node.id == "__name__" for node in ast.walk(tree))
+
+class MpyCross(object):
+   """ Compile python source into .mpy files using mpy-cross. Results are
+   cached by the hash of the source and the target, so unchanged files are
+   only compiled once """
+
+   def __init__(self, cachedir, binary=None):
+      self.cachedir = cachedir
+      self.binary = binary or getattr(mpy_cross, "mpy_cross", None) or shutil.which("mpy-cross")
+      if self.binary and not os.path.isfile(self.binary): self.binary = None
+      self.version = None
+      self.mpy = 0
+
+   def set_target(self, mpy):
+      # mpy is sys.implementation._mpy of the device. Devices not
+      # reporting it cannot be compiled for
+      self.mpy = mpy
+
+   def available(self):
+      return self.binary is not None and (self.mpy & 0xff) != 0
+
+   def compile(self, source, name):
+      """ return the .mpy of the given source. The name is used in
+      tracebacks. Raises an exception with the compiler's message if the
+      source cannot be compiled and returns None if no matching compiler
+      is available """
+      if not self.available(): return None
+      if isinstance(source, str): source = source.encode("utf-8")
+
+      # the compiler itself may be updated at any time
+      if self.version is None:
+         self.version = subprocess.run([ self.binary, "--version" ], capture_output=True).stdout
+
+      arch = (self.mpy >> 10) & 0x0f
+      march = ARCHS[arch] if arch < len(ARCHS) else None
+      key = hashlib.sha1(self.version + bytes(name, "utf-8") + b"\0" +
+                         bytes(str(self.mpy), "ascii") + b"\0" + source).hexdigest()
+      cached = os.path.join(self.cachedir, key + ".mpy")
+      if os.path.isfile(cached):
+         with open(cached, 'rb') as f:
+            return f.read()
+
+      with tempfile.TemporaryDirectory() as tmp:
+         src = os.path.join(tmp, "src.py")
+         dst = os.path.join(tmp, "src.mpy")
+         with open(src, 'wb') as f:
+            f.write(source)
+         args = [ self.binary, "-s", name, "-o", dst ]
+         if march: args.append("-march=" + march)
+         ret = subprocess.run(args + [ src ], capture_output=True)
+         if ret.returncode:
+            raise ValueError(ret.stderr.decode("utf-8", "replace").replace(src, name))
+         with open(dst, 'rb') as f:
+            data = f.read()
+
+      # the compiler has to produce the mpy version the device expects
+      if len(data) < 2 or data[0] != ord("M") or data[1] != self.mpy & 0xff:
+         return None
+
+      os.makedirs(self.cachedir, exist_ok=True)
+      with open(cached, 'wb') as f:
+         f.write(data)
+      return data
@@ -0,0 +1,163 @@
+#
+# plotter.py
+#
+# Copyright (C) 2021 Till Harbaum <till@harbaum.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51 Franklin
+# Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from PyQt5.QtWidgets import *
+from PyQt5.QtGui import *
+from PyQt5.QtCore import *
+
+import time
+
+# plotting is only available if numpy is installed
+try:
+   import numpy
+except ImportError:
+   numpy = None
+
+from console import ansi_color
+
+# colors of the channels, taken from the console palette
+COLORS = [ 4, 1, 2, 5, 6, 3, 12, 9 ]
+
+class Plotter(QWidget):
+   """ Plot numeric lines printed by the board. Each line may contain up
+   to CHANNELS values separated by commas, semicolons or spaces. Other
+   lines are ignored. Samples are kept in ring buffers and the plot is
+   redrawn at most once per FRAME ms """
+
+   # number of samples kept per channel and max number of channels
+   SAMPLES = 100000
+   CHANNELS = 8
+
+   # the plot is redrawn at most once per FRAME ms
+   FRAME = 40
+
+   # lines longer than this are not going to be numeric data
+   MAX_LINE = 1024
+
+   @staticmethod
+   def available():
+      return numpy is not None
+
+   def __init__(self, samples=SAMPLES):
+      super().__init__()
+      self.setMinimumSize(100, 50)
+
+      # the ring buffer, one row per channel. Channels missing in a
+      # line are nan and not drawn
+      self.samples = samples
+      self.data = numpy.full((Plotter.CHANNELS, samples), numpy.nan)
+      self.pad = [ numpy.nan ] * Plotter.CHANNELS
+      self.clear()
+
+      self.timer = QTimer(self)
+      self.timer.setSingleShot(True)
+      self.timer.timeout.connect(self.update)
+      self.drawn = 0
+
+   def clear(self):
+      self.line = bytearray()
+      self.data.fill(numpy.nan)
+      self.pos = 0         # index the next sample is written to
+      self.count = 0       # number of samples in the buffer
+      self.channels = 0    # highest number of values seen in a line
+      self.update()
+
+   def parse(self, line):
+      fields = line.replace(b",", b" ").replace(b";", b" ").split()
+      if not fields or len(fields) > Plotter.CHANNELS: return None
+      try:
+         return [ float(f) for f in fields ]
+      except ValueError:
+         return None
+
+   def feed(self, b):
+      # only complete lines are parsed, the rest is kept for later
+      self.line.extend(b)
+      lines = self.line.split(b"\n")
+      self.line = lines.pop()
+      if len(self.line) > Plotter.MAX_LINE: self.line = bytearray()
+
+      rows = [ ]
+      for line in lines:
+         values = self.parse(line)
+         if values: rows.append(values)
+      if rows: self.store(rows)
+
+   def store(self, rows):
+      # anything beyond the size of the buffer would be overwritten anyway
+      rows = rows[-self.samples:]
+      self.channels = max(self.channels, max(len(r) for r in rows))
+      block = numpy.array([ r + self.pad[len(r):] for r in rows ]).T
+
+      # the block may wrap around the end of the buffer
+      n = block.shape[1]
+      first = min(n, self.samples - self.pos)
+      self.data[:, self.pos:self.pos+first] = block[:, :first]
+      self.data[:, :n-first] = block[:, first:]
+      self.pos = (self.pos + n) % self.samples
+      self.count = min(self.count + n, self.samples)
+
+      # redraw once the current frame is over
+      if not self.timer.isActive():
+         wait = self.drawn + Plotter.FRAME / 1000 - time.monotonic()
+         if wait > 0: self.timer.start(int(1000 * wait) + 1)
+         else:        self.update()
+
+   def ordered(self):
+      # the samples of all used channels, oldest first
+      data = self.data[:self.channels]
+      if self.count < self.samples: return data[:, :self.count]
+      return numpy.concatenate((data[:, self.pos:], data[:, :self.pos]), axis=1)
+
+   def paintEvent(self, event):
+      self.drawn = time.monotonic()
+      painter = QPainter(self)
+      painter.fillRect(self.rect(), Qt.white)
+      if not self.count: return
+
+      data = self.ordered()
+      lo, hi = numpy.fmin.reduce(data, axis=None), numpy.fmax.reduce(data, axis=None)
+      if numpy.isnan(lo): return
+      if lo == hi: lo, hi = lo - 1, hi + 1
+
+      # with more samples than pixels only the min and max of the
+      # samples falling onto each pixel column are drawn
+      w, h = self.width(), self.height()
+      if data.shape[1] > 2 * w:
+         per = data.shape[1] // w
+         bins = data[:, -w*per:].reshape(data.shape[0], w, per)
+         data = numpy.empty((data.shape[0], 2 * w))
+         data[:, 0::2] = numpy.fmin.reduce(bins, axis=2)
+         data[:, 1::2] = numpy.fmax.reduce(bins, axis=2)
+
+      xs = numpy.linspace(0, w - 1, data.shape[1])
+      ys = (h - 1) * (hi - data) / (hi - lo)
+
+      for channel in range(data.shape[0]):
+         valid = ~numpy.isnan(ys[channel])
+         points = [ QPointF(x, y) for x, y in zip(xs[valid].tolist(), ys[channel][valid].tolist()) ]
+         painter.setPen(ansi_color(COLORS[channel]))
+         painter.drawPolyline(QPolygonF(points))
+
+      # value range and number of samples shown
+      painter.setPen(Qt.darkGray)
+      metrics = painter.fontMetrics()
+      painter.drawText(2, metrics.ascent(), "{:g}".format(hi))
+      painter.drawText(2, h - metrics.descent(), "{:g}".format(lo))
+      text = self.tr("{} samples").format(self.count)
+      painter.drawText(w - metrics.width(text) - 2, metrics.ascent(), text)
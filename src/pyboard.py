@@ -71,6 +71,8 @@ import sys
 import time
 import os
 import ast
+import binascii
+import zlib
 
 try:
     stdout = sys.stdout.buffer
@@ -251,12 +253,46 @@ class ProcessPtyToTerminal:
         return self.ser.inWaiting()
 
 
+class Base64LineDecoder:
+    """Decode base64 encoded lines as they arrive and pass the result on.
+    Lines starting with # or ! are not base64 and are passed to the
+    marker_consumer instead."""
+
+    def __init__(self, data_consumer, marker_consumer=None):
+        self.data_consumer = data_consumer
+        self.marker_consumer = marker_consumer
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer.extend(data)
+
+        # only complete lines can be decoded. Anything after the last
+        # newline (e.g. the final EOF) stays in the buffer
+        end = self.buffer.rfind(b"\n")
+        if end < 0:
+            return
+        lines = self.buffer[: end + 1]
+        del self.buffer[: end + 1]
+
+        for line in lines.split(b"\n"):
+            line = line.strip()
+            if line and self.marker_consumer and line[:1] in b"#!":
+                self.marker_consumer(bytes(line))
+            elif line:
+                try:
+                    self.data_consumer(binascii.a2b_base64(line))
+                except binascii.Error as e:
+                    raise PyboardError("fs_get: Could not interpret received data: %s" % str(e))
+
+
 class Pyboard:
     def __init__(
         self, device, baudrate=115200, user="micro", password="python", wait=0, exclusive=True
     ):
         self.in_raw_repl = False
         self.use_raw_paste = True
+        self.use_deflate = None  # device can decompress deflate streams, probed on first use
+        self._interrupt = False  # set from another thread to stop waiting for the device
         if device.startswith("exec:"):
             self.serial = ProcessToSerial(device[len("exec:") :])
         elif device.startswith("execpty:"):
@@ -302,6 +338,11 @@ class Pyboard:
         # if data_consumer is used then data is not accumulated and the ending must be 1 byte long
         assert data_consumer is None or len(ending) == 1
 
+        # the buffered serial port can search its buffer and wait for data
+        # which allows to read everything up to the ending in one go
+        if hasattr(self.serial, "find"):
+            return self.read_until_buffered(min_num_bytes, ending, timeout, data_consumer)
+
         data = self.serial.read(min_num_bytes)
         if data_consumer:
             data_consumer(data)
@@ -326,6 +367,58 @@ class Pyboard:
                 time.sleep(0.01)
         return data
 
+    def read_until_buffered(self, min_num_bytes, ending, timeout=10, data_consumer=None):
+        data = self.serial.read(min_num_bytes)
+        if data_consumer:
+            data_consumer(data)
+        else:
+            data = bytearray(data)
+
+        # the timeout restarts whenever data has been received
+        deadline = None if timeout is None else time.monotonic() + timeout
+        overlap = len(ending) - 1
+        while not data.endswith(ending):
+            # the ending may be split between the data already read and the
+            # data still buffered
+            chunk = None
+            if overlap and not data_consumer:
+                tail = data[-overlap:]
+                pos = (tail + self.serial.peek(overlap)).find(ending)
+                if 0 <= pos < len(tail):
+                    chunk = self.serial.read(pos + len(ending) - len(tail))
+
+            if chunk is None:
+                # read up to and including the ending if it's in the buffer
+                # or everything available otherwise
+                pos = self.serial.find(ending)
+                if pos >= 0:
+                    chunk = self.serial.read(pos + len(ending))
+                elif self.serial.inWaiting() > 0:
+                    chunk = self.serial.read(self.serial.inWaiting())
+
+            if chunk:
+                if data_consumer:
+                    data_consumer(chunk)
+                    data = chunk
+                else:
+                    data += chunk
+                if timeout is not None:
+                    deadline = time.monotonic() + timeout
+                continue
+
+            if self._interrupt:
+                raise RuntimeError("Stop failed")
+
+            # nothing there, block until more data arrives. Wake up regularly
+            # to check for interruption
+            wait = 0.1
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    break
+            self.serial.wait(wait)
+        return bytes(data)
+
     def enter_raw_repl(self, soft_reset=True):
         # print("enter raw repl", soft_reset, self.serial)
 
@@ -528,47 +621,261 @@ class Pyboard:
                 progress_callback(written, src_size)
         self.exec_("fr.close()\nfw.close()")
 
-    def fs_get(self, src, dest, chunk_size=256, progress_callback=None):
+    def fs_stream(self, src, data_consumer, chunk_size=4096):
+        # Read a whole file in a single exec. The device sends base64
+        # encoded lines of chunk_size bytes each which are decoded as they
+        # arrive. Devices without binascii fall back to reading the file
+        # in small chunks of python literals.
+        cmd = (
+            "try:\n import binascii\nexcept ImportError:\n import ubinascii as binascii\n"
+            "f=open('%s','rb')\nb=bytearray(%u)\nm=memoryview(b)\nwhile 1:\n"
+            " n=f.readinto(b)\n if not n:break\n"
+            " print(binascii.b2a_base64(m[:n]).decode(),end='')\nf.close()" % (src, chunk_size)
+        )
+        decoder = Base64LineDecoder(data_consumer)
+        try:
+            self.exec_(cmd, data_consumer=decoder.feed)
+        except PyboardError as er:
+            if len(er.args) < 3 or b"ImportError" not in er.args[2]:
+                raise
+            self.fs_stream_literal(src, data_consumer)
+
+    def fs_stream_many(self, srcs, file_consumer, progress_callback=None, chunk_size=4096, data_consumer=None):
+        # Read several files in a single exec. Each file is preceded by a
+        # marker line, "#" if it could be opened or "!<error>" if not.
+        # file_consumer(index, data, error) is called for every complete
+        # file, progress_callback(index, received) while data arrives.
+        # If data_consumer(index, chunk) is given, the data is passed to
+        # it as it arrives and file_consumer receives None instead.
+        cmd = (
+            "try:\n import binascii\nexcept ImportError:\n import ubinascii as binascii\n"
+            "b=bytearray(%u)\nm=memoryview(b)\nfor s in %r:\n"
+            " try:\n  f=open(s,'rb')\n except OSError as e:\n  print('!',e)\n  continue\n"
+            " print('#')\n while 1:\n  n=f.readinto(b)\n  if not n:break\n"
+            "  print(binascii.b2a_base64(m[:n]).decode(),end='')\n f.close()" % (chunk_size, list(srcs))
+        )
+        index = -1
+        data = None
+        received = 0
+        error = None
+
+        def finish():
+            if index >= 0:
+                file_consumer(index, data, error)
+
+        def on_marker(line):
+            nonlocal index, data, received, error
+            finish()
+            index += 1
+            data = None if data_consumer else bytearray()
+            received = 0
+            error = None if line.startswith(b"#") else line[1:].strip().decode("utf-8", "replace")
+            if progress_callback:
+                progress_callback(index, 0)
+
+        def on_data(chunk):
+            nonlocal received
+            if data_consumer:
+                data_consumer(index, chunk)
+            else:
+                data.extend(chunk)
+            received += len(chunk)
+            if progress_callback:
+                progress_callback(index, received)
+
+        try:
+            self.exec_(cmd, data_consumer=Base64LineDecoder(on_data, on_marker).feed)
+        except PyboardError as er:
+            if len(er.args) < 3 or b"ImportError" not in er.args[2]:
+                raise
+
+            # no binascii, read the files one by one
+            for i, src in enumerate(srcs):
+                on_marker(b"#")
+                try:
+                    self.fs_stream_literal(src, on_data)
+                except PyboardError as e:
+                    error = str(e.args[2], "utf-8", "replace") if len(e.args) > 2 else str(e)
+        finish()
+
+    def fs_stream_literal(self, src, data_consumer, chunk_size=256):
+        self.exec_("f=open('%s','rb')\nr=f.read" % src)
+        while True:
+            data = bytearray()
+            self.exec_("print(r(%u))" % chunk_size, data_consumer=lambda d: data.extend(d))
+            assert data.endswith(b"\r\n\x04")
+            try:
+                data = ast.literal_eval(str(data[:-3], "ascii"))
+                if not isinstance(data, bytes):
+                    raise ValueError("Not bytes")
+            except (UnicodeError, ValueError) as e:
+                raise PyboardError("fs_get: Could not interpret received data: %s" % str(e))
+            if not data:
+                break
+            data_consumer(data)
+        self.exec_("f.close()")
+
+    def fs_get(self, src, dest, chunk_size=4096, progress_callback=None):
         if progress_callback:
             src_size = int(self.exec_("import os\nprint(os.stat('%s')[6])" % src))
             written = 0
-        self.exec_("f=open('%s','rb')\nr=f.read" % src)
         with open(dest, "wb") as f:
-            while True:
-                data = bytearray()
-                self.exec_("print(r(%u))" % chunk_size, data_consumer=lambda d: data.extend(d))
-                assert data.endswith(b"\r\n\x04")
-                try:
-                    data = ast.literal_eval(str(data[:-3], "ascii"))
-                    if not isinstance(data, bytes):
-                        raise ValueError("Not bytes")
-                except (UnicodeError, ValueError) as e:
-                    raise PyboardError("fs_get: Could not interpret received data: %s" % str(e))
-                if not data:
-                    break
+
+            def write(data):
+                nonlocal written
                 f.write(data)
                 if progress_callback:
                     written += len(data)
                     progress_callback(written, src_size)
-        self.exec_("f.close()")
 
-    def fs_put(self, src, dest, chunk_size=256, progress_callback=None):
-        if progress_callback:
-            src_size = os.path.getsize(src)
-            written = 0
-        self.exec_("f=open('%s','wb')\nw=f.write" % dest)
+            self.fs_stream(src, write, chunk_size)
+
+    def fs_put(self, src, dest, chunk_size=1024, progress_callback=None):
         with open(src, "rb") as f:
-            while True:
-                data = f.read(chunk_size)
-                if not data:
-                    break
-                if sys.version_info < (3,):
-                    self.exec_("w(b" + repr(data) + ")")
-                else:
-                    self.exec_("w(" + repr(data) + ")")
-                if progress_callback:
-                    written += len(data)
-                    progress_callback(written, src_size)
+            data = f.read()
+        self.fs_put_stream(data, dest, chunk_size, progress_callback=progress_callback)
+
+    def fs_put_stream(self, data, dest, chunk_size=1024, window=1, progress_callback=None):
+        # Write a whole file in a single exec. A small receiver program reads
+        # base64 encoded lines from stdin and acknowledges each line once it
+        # has been written. At most window lines are sent ahead of the last
+        # acknowledgement so the device's input buffer cannot overflow while
+        # it is busy writing to flash. The default window of 1 is stop-and-wait
+        # per line: the device reads a line while it's arriving, but many
+        # ports only buffer a few hundred bytes while flash is being written.
+        # Devices with larger input buffers may use a larger window. Devices
+        # without binascii fall back to writing python literals chunk by chunk.
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        cmd = (
+            "import sys\n"
+            "try:\n import binascii\nexcept ImportError:\n import ubinascii as binascii\n"
+            "f=open('%s','wb')\nw=sys.stdout.write\nw('\\x01')\nwhile 1:\n"
+            " l=sys.stdin.readline().rstrip()\n if not l:break\n"
+            " f.write(binascii.a2b_base64(l))\n w('\\x01')\nf.close()" % dest
+        )
+        self.exec_raw_no_follow(cmd)
+
+        # the receiver indicates that it's ready with a first ack
+        try:
+            self.fs_put_wait_ack()
+        except PyboardError as er:
+            if len(er.args) < 3 or b"ImportError" not in er.args[2]:
+                raise
+            return self.fs_put_literal(data, dest, progress_callback=progress_callback)
+
+        pending = 0
+        for i in range(0, len(data), chunk_size):
+            while pending >= window:
+                self.fs_put_wait_ack()
+                pending -= 1
+            self.serial.write(binascii.b2a_base64(data[i : i + chunk_size]))
+            pending += 1
+            if progress_callback:
+                progress_callback(min(i + chunk_size, len(data)), len(data))
+        while pending:
+            self.fs_put_wait_ack()
+            pending -= 1
+
+        # an empty line ends the transfer
+        self.serial.write(b"\n")
+        ret, ret_err = self.follow(10)
+        if ret_err:
+            raise PyboardError("exception", ret, ret_err)
+
+    # raw deflate decompression on the device. MicroPython 1.21 and later
+    # have the deflate module, older versions (u)zlib.DecompIO
+    DEFLATE_IMPORT = (
+        "try:\n from deflate import DeflateIO,RAW\n d=lambda f:DeflateIO(f,RAW,%u)\n"
+        "except ImportError:\n try:\n  from zlib import DecompIO\n except ImportError:\n"
+        "  from uzlib import DecompIO\n d=lambda f:DecompIO(f,-%u)\n"
+    )
+
+    def fs_put_deflate(self, data, dest, chunk_size=1024, window=1, progress_callback=None,
+                       wbits=10, min_size=1024):
+        # Write a whole file compressed with raw deflate. The compressed data
+        # is written to a hidden temporary file which is then decompressed on
+        # the device. The small window keeps the device's memory use low. Small
+        # or badly compressible files and devices without decompression
+        # support use the uncompressed transfer. So does a failure on the
+        # device, e.g. if there's not enough space for the temporary file.
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        if len(data) >= min_size and self.use_deflate is None:
+            try:
+                self.exec_(self.DEFLATE_IMPORT % (wbits, wbits))
+                self.use_deflate = True
+            except PyboardError as er:
+                if len(er.args) < 3 or b"ImportError" not in er.args[2]:
+                    raise
+                self.use_deflate = False
+
+        if len(data) >= min_size and self.use_deflate:
+            packer = zlib.compressobj(9, zlib.DEFLATED, -wbits)
+            packed = packer.compress(data) + packer.flush()
+            if len(packed) < len(data) * 9 // 10:
+                tmp = "/.upide_tmp.z"
+                try:
+                    self.fs_put_stream(packed, tmp, chunk_size, window, progress_callback)
+                    self.exec_(
+                        (self.DEFLATE_IMPORT % (wbits, wbits))
+                        + "import uos\nwith open('%s','rb') as s,open('%s','wb') as f:\n"
+                        " z=d(s)\n b=bytearray(512)\n m=memoryview(b)\n while 1:\n"
+                        "  n=z.readinto(b)\n  if not n:break\n  f.write(m[:n])\n"
+                        "uos.remove('%s')" % (tmp, dest, tmp)
+                    )
+                    return
+                except PyboardError as er:
+                    # only exceptions raised on the device leave it ready
+                    # for the uncompressed transfer
+                    if len(er.args) < 3:
+                        raise
+                    self.exec_("import uos\ntry:\n uos.remove('%s')\nexcept OSError:\n pass" % tmp)
+
+        self.fs_put_stream(data, dest, chunk_size, window, progress_callback)
+
+    def fs_put_wait_ack(self, timeout=10):
+        # the port has no read timeout, so only data already there is
+        # read. Otherwise wait for more with the remaining time
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.serial.inWaiting() > 0:
+                data = self.serial.read(1)
+                if data == b"\x01":
+                    return
+                if data == b"\x04":
+                    # the receiver has stopped, most likely due to an exception
+                    data_err = self.read_until(1, b"\x04")
+                    raise PyboardError("exception", b"", data_err[:-1])
+                raise PyboardError("unexpected read during upload: {}".format(data))
+
+            if self._interrupt:
+                raise RuntimeError("Stop failed")
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise PyboardError("timeout waiting for upload acknowledge")
+
+            # wake up regularly to check for interruption
+            if hasattr(self.serial, "wait"):
+                self.serial.wait(min(0.1, remaining))
+            else:
+                time.sleep(0.01)
+
+    def fs_put_literal(self, data, dest, chunk_size=256, progress_callback=None):
+        written = 0
+        self.exec_("f=open('%s','wb')\nw=f.write" % dest)
+        for i in range(0, len(data), chunk_size):
+            chunk = data[i : i + chunk_size]
+            if sys.version_info < (3,):
+                self.exec_("w(b" + repr(chunk) + ")")
+            else:
+                self.exec_("w(" + repr(chunk) + ")")
+            if progress_callback:
+                written += len(chunk)
+                progress_callback(written, len(data))
         self.exec_("f.close()")
 
     def fs_mkdir(self, dir):
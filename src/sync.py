@@ -0,0 +1,411 @@
+#
+# sync.py
+#
+# Copyright (C) 2021 Till Harbaum <till@harbaum.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51 Franklin
+# Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from PyQt5.QtCore import *
+
+import os, json, hashlib
+
+from board import Board
+
+# the digests of all files as of the last sync are kept in the local
+# folder. They tell which side has changed a file since then
+STATE_FILE = ".upide_sync"
+
+def local_digests(folder):
+   """ return the SHA-1 of all files of a local folder, keyed by their
+   path on the board. Hidden files and directories (e.g. .git) and
+   python caches are skipped """
+   digests = { }
+   for root, dirs, files in os.walk(folder):
+      dirs[:] = [ d for d in dirs if not d.startswith(".") and d != "__pycache__" ]
+      for name in files:
+         if name.startswith("."): continue
+         fname = os.path.join(root, name)
+         digest = hashlib.sha1()
+         with open(fname, 'rb') as f:
+            data = f.read(65536)
+            while data:
+               digest.update(data)
+               data = f.read(65536)
+         path = "/" + os.path.relpath(fname, folder).replace(os.sep, "/")
+         digests[path] = digest.digest()
+   return digests
+
+class Sync(QObject):
+   """ Two-way sync between a local folder and the board. The digests of
+   both sides are compared with the ones of the last sync to find out on
+   which side a file has been created, modified or deleted. Only those
+   changes are then transferred. If a file has been modified on both sides,
+   the local version wins """
+
+   message = pyqtSignal(str, str)       # status bar and console message
+   uploaded = pyqtSignal(str, bytes)    # name and new contents of a file on the board
+   done = pyqtSignal(bool)
+
+   def __init__(self, board, folder, parent=None):
+      super().__init__(parent)
+      self.board = board
+      self.folder = folder
+      self.finished = False
+      self.futures = [ ]
+
+   def cmd(self, cmd, cb, parms=None):
+      # on failure only the commands queued here are cancelled
+      self.futures.append(self.board.cmd(cmd, cb, parms))
+
+   def local_name(self, path):
+      return os.path.join(self.folder, *path.lstrip("/").split("/"))
+
+   def start(self, files):
+      # files is a list of ( path, size ) of all files on the board
+      self.sizes = dict(files)
+
+      try:
+         with open(os.path.join(self.folder, STATE_FILE)) as f:
+            self.base = { p: bytes.fromhex(d) for p, d in json.load(f).items() }
+      except (OSError, ValueError, AttributeError):
+         self.base = { }   # first sync, nothing is known about deletions
+
+      try:
+         self.local = local_digests(self.folder)
+      except OSError as e:
+         self.message.emit(self.tr("Sync failed"), str(e))
+         self.finish(False)
+         return
+
+      self.cmd(Board.HASH, self.on_hash, len(files))
+
+   def plan(self, remote):
+      # compute the change set. Returns lists of paths to upload to and
+      # download from the board and to remove from the board and locally
+      uploads, downloads, remove, delete = [ ], [ ], [ ], [ ]
+      self.state = { }
+      for path in sorted(set(self.local) | set(remote)):
+         here, there, base = self.local.get(path), remote.get(path), self.base.get(path)
+         if here is not None and path in remote:
+            if here == there:
+               self.state[path] = here
+            elif there is None or there == base:
+               uploads.append(path)     # only modified locally or unreadable
+            elif here == base:
+               downloads.append(path)   # only modified on the board
+            else:
+               self.message.emit(self.tr("Conflict {}").format(path.split("/")[-1]),
+                                 self.tr("Modified on both sides, keeping local {}").format(path))
+               uploads.append(path)
+         elif here is not None:
+            if here == base: delete.append(path)    # deleted on the board
+            else:            uploads.append(path)
+         elif there is not None:
+            if there == base: remove.append(path)   # deleted locally
+            else:             downloads.append(path)
+
+      return uploads, downloads, remove, delete
+
+   def on_hash(self, success, hashes=None):
+      if not success:
+         self.finish(False)
+         return
+
+      uploads, downloads, remove, delete = self.plan(hashes)
+
+      # directories containing any file are known to exist on the board
+      dirs = set()
+      for path in hashes:
+         parts = path.split("/")[1:-1]
+         for i in range(len(parts)):
+            dirs.add("/" + "/".join(parts[:i+1]))
+
+      mkdirs = set()
+      for path in uploads:
+         parts = path.split("/")[1:-1]
+         for i in range(len(parts)):
+            d = "/" + "/".join(parts[:i+1])
+            if not d in dirs: mkdirs.add(d)
+
+      try:
+         for path in delete:
+            self.message.emit(self.tr("Deleting {}").format(path.split("/")[-1]),
+                              self.tr("Deleting local {}").format(path))
+            os.remove(self.local_name(path))
+      except OSError as e:
+         self.message.emit(self.tr("Sync failed"), str(e))
+         self.finish(False)
+         return
+
+      # everything else is queued at once and processed back to back
+      self.remote = hashes
+      self.pending = len(uploads) + len(downloads)
+      if remove:
+         self.cmd(Board.REMOVE, self.on_removed, remove)
+      if mkdirs:
+         # parents sort before their subdirectories
+         self.cmd(Board.MKDIRS, self.on_mkdirs, sorted(mkdirs))
+      for path in uploads:
+         self.cmd(Board.PUT_FILE, self.on_uploaded,
+                  { "name": path, "quiet": True, "source": self.read_local } )
+      for path in downloads:
+         self.cmd(Board.GET_FILE, self.on_downloaded,
+                  { "name": path, "size": self.sizes.get(path, 0), "quiet": True,
+                    "sink": self.open_local } )
+
+      if not self.pending and not remove:
+         self.finish(True)
+
+   def read_local(self, parms):
+      # called from the worker thread right before the file is sent
+      with open(self.local_name(parms["name"]), 'rb') as f:
+         return f.read()
+
+   def open_local(self, parms):
+      # called from the worker thread once a file is being read. It's
+      # written under a temporary name until it's complete
+      fname = self.local_name(parms["name"])
+      os.makedirs(os.path.dirname(fname), exist_ok=True)
+      return open(fname + ".part", 'wb')
+
+   def on_removed(self, success, names=None):
+      if self.finished: return
+      if not success:
+         self.board.cancel(self.futures)
+         self.finish(False)
+         return
+
+      for path in names:
+         self.message.emit(self.tr("Deleted {}").format(path.split("/")[-1]),
+                           self.tr("Deleted {}").format(path))
+
+      if not self.pending:
+         self.finish(True)
+
+   def on_mkdirs(self, success, dirs=None):
+      if not success and not self.finished:
+         self.board.cancel(self.futures)
+         self.finish(False)
+
+   def on_uploaded(self, success, parms=None):
+      if self.finished: return
+      if not success:
+         self.board.cancel(self.futures)
+         self.finish(False)
+         return
+
+      self.state[parms["name"]] = hashlib.sha1(parms["code"]).digest()
+      self.message.emit(self.tr("Uploaded {}").format(parms["name"].split("/")[-1]),
+                        self.tr("Uploaded {}").format(parms["name"]))
+      self.uploaded.emit(parms["name"], parms["code"])
+      self.file_done()
+
+   def on_downloaded(self, success, parms=None):
+      if self.finished: return
+      fname = self.local_name(parms["name"]) if parms else None
+      try:
+         if not success: raise OSError(self.tr("Board com failed"))
+         os.replace(fname + ".part", fname)
+      except OSError as e:
+         if fname and os.path.exists(fname + ".part"): os.remove(fname + ".part")
+         self.board.cancel(self.futures)
+         self.message.emit(self.tr("Sync failed"), str(e))
+         self.finish(False)
+         return
+
+      self.state[parms["name"]] = self.remote[parms["name"]]
+      self.message.emit(self.tr("Downloaded {}").format(parms["name"].split("/")[-1]),
+                        self.tr("Downloaded {}").format(parms["name"]))
+      self.file_done()
+
+   def file_done(self):
+      self.pending -= 1
+      if not self.pending:
+         self.finish(True)
+
+   def finish(self, ok):
+      if self.finished: return
+      self.finished = True
+
+      # only a complete sync is a valid base for the next one
+      if ok:
+         try:
+            with open(os.path.join(self.folder, STATE_FILE), 'w') as f:
+               json.dump({ p: d.hex() for p, d in self.state.items() }, f, indent=1)
+         except OSError as e:
+            self.message.emit(self.tr("Sync failed"), str(e))
+            ok = False
+
+      self.done.emit(ok)
+
+class Watcher(QObject):
+   """ Watch a local folder and upload files to the board once they have
+   been modified. Changes are collected until the folder has been quiet
+   for a moment, so saving a file several times in a row or editors writing
+   files in several steps result in a single upload """
+
+   message = pyqtSignal(str, str)       # status bar and console message
+   uploaded = pyqtSignal(str, bytes)    # name and new contents of a file on the board
+   removed = pyqtSignal(list)           # names of files removed from the board
+
+   # time in ms without further changes before uploading
+   DELAY = 500
+
+   # files run by the device itself which cannot be replaced by a .mpy
+   SOURCE_ONLY = [ "main.py", "boot.py" ]
+
+   def __init__(self, board, folder, compiler=None, parent=None):
+      super().__init__(parent)
+      self.board = board
+      self.folder = folder
+      self.compiler = compiler  # python files are uploaded as .mpy if set
+      self.replaced = set()     # sources already replaced by a .mpy on the board
+      self.dirty = set()        # paths modified since the last upload
+      self.queued = { }         # futures of uploads not yet done by path
+      self.created = set()      # directories known to exist on the board
+
+      # changes are only uploaded if the contents really differ from
+      # what they were when watching started or when last uploaded
+      self.digests = local_digests(folder)
+
+      self.watcher = QFileSystemWatcher(self)
+      self.watcher.fileChanged.connect(self.on_changed)
+      self.watcher.directoryChanged.connect(self.on_changed)
+      self.timer = QTimer(self)
+      self.timer.setSingleShot(True)
+      self.timer.timeout.connect(self.on_timer)
+      self.scan(folder)
+
+   def stop(self):
+      self.timer.stop()
+      self.watcher.removePaths(self.watcher.files() + self.watcher.directories())
+
+   def path(self, fname):
+      return "/" + os.path.relpath(fname, self.folder).replace(os.sep, "/")
+
+   def scan(self, dirname):
+      # watch a directory and everything inside it. New files are marked
+      # as modified, so they get uploaded
+      watched = set(self.watcher.files() + self.watcher.directories())
+      new = [ ]
+      for root, dirs, files in os.walk(dirname):
+         dirs[:] = [ d for d in dirs if not d.startswith(".") and d != "__pycache__" ]
+         names = [ root ] + [ os.path.join(root, f) for f in files if not f.startswith(".") ]
+         for name in names:
+            if not name in watched:
+               new.append(name)
+               if os.path.isfile(name) and not self.path(name) in self.digests:
+                  self.dirty.add(name)
+      if new: self.watcher.addPaths(new)
+
+   def on_changed(self, name):
+      if os.path.isdir(name):
+         self.scan(name)
+      elif os.path.isfile(name):
+         self.dirty.add(name)
+         # many editors replace a file when saving it which ends watching it
+         if not name in self.watcher.files(): self.watcher.addPath(name)
+
+      # restart the delay with every change
+      self.timer.start(Watcher.DELAY)
+
+   def on_timer(self):
+      dirty, self.dirty = self.dirty, set()
+      for fname in sorted(dirty):
+         path = self.path(fname)
+
+         # a cancelled upload, e.g. after the board was lost, never reports
+         # back and is simply replaced by a new one. Directories queued
+         # along with it may not have been created either
+         if path in self.queued and self.queued[path].cancelled():
+            del self.queued[path]
+            self.created.clear()
+            self.replaced.clear()
+
+         # an upload that hasn't started yet will send the latest contents
+         # anyway. Compiled files are sent as they were and a running upload
+         # may already have read the file, so these have to wait for the
+         # upload to finish. A finished upload is sure to report back
+         if path in self.queued:
+            future = self.queued[path]
+            if self.compiler or future.running() or future.done():
+               self.dirty.add(fname)
+               self.timer.start(Watcher.DELAY)
+            continue
+         try:
+            with open(fname, 'rb') as f:
+               data = f.read()
+         except OSError:
+            continue   # removed again in the meantime
+         digest = hashlib.sha1(data).digest()
+         if self.digests.get(path) == digest: continue
+
+         parms = { "name": path, "path": path, "digest": digest, "fname": fname,
+                   "quiet": True, "source": self.read_local }
+         if self.compiler and path.endswith(".py") and not path.split("/")[-1] in Watcher.SOURCE_ONLY:
+            try:
+               code = self.compiler.compile(data, path)
+            except (OSError, ValueError) as e:
+               self.message.emit(self.tr("Compiling {} failed").format(path.split("/")[-1]), str(e))
+               continue
+
+            # without a matching compiler the source is uploaded
+            if code is not None:
+               parms = { "name": path[:-3] + ".mpy", "path": path, "digest": digest,
+                         "quiet": True, "code": code }
+
+         parts = path.split("/")[1:-1]
+         mkdirs = [ "/" + "/".join(parts[:i+1]) for i in range(len(parts)) ]
+         mkdirs = [ d for d in mkdirs if not d in self.created ]
+         if mkdirs:
+            self.board.cmd(Board.MKDIRS, self.on_mkdirs, mkdirs)
+            self.created.update(mkdirs)
+
+         self.queued[path] = self.board.cmd(Board.PUT_FILE, self.on_uploaded, parms)
+
+         # the source would be imported instead of the .mpy
+         if parms["name"] != path and not path in self.replaced:
+            self.board.cmd(Board.REMOVE, self.on_removed, [ path ])
+            self.replaced.add(path)
+
+   def read_local(self, parms):
+      # called from the worker thread right before the file is sent
+      with open(parms["fname"], 'rb') as f:
+         return f.read()
+
+   def on_mkdirs(self, success, dirs=None):
+      # a failure will show up once the files are written
+      pass
+
+   def on_removed(self, success, names=None):
+      if success: self.removed.emit(names)
+
+   def on_uploaded(self, success, parms=None):
+      if not success:
+         # retry with the next change
+         self.queued.clear()
+         self.created.clear()
+         self.replaced.clear()
+         self.message.emit(self.tr("Upload failed"), self.tr("Upload failed"))
+         return
+
+      self.queued.pop(parms["path"], None)
+      if parms["name"] == parms["path"]:
+         # the file may have changed since it was hashed
+         self.digests[parms["path"]] = hashlib.sha1(parms["code"]).digest()
+      else:
+         self.digests[parms["path"]] = parms["digest"]
+      self.message.emit(self.tr("Uploaded {}").format(parms["name"].split("/")[-1]),
+                        self.tr("Uploaded {}").format(parms["name"]))
+      self.uploaded.emit(parms["name"], parms["code"])
@@ -17,17 +17,22 @@
 # Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
-import os, sys, time, hashlib
+import os, sys, time
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 
 from board import Board
+from backup import Backup, Restore
+from sync import Sync, Watcher
+import mpycross
+from mpycross import MpyCross
+from capture import Capture, CaptureReader
 from fileview import FileView
 from console import Console
+from plotter import Plotter
 from editors import Editors
 from esp_installer import EspInstaller
-import zipfile
 
 class Window(QMainWindow):
    def __init__(self, app, flags):
@@ -37,6 +42,8 @@ class Window(QMainWindow):
 
       # try to load settings
       self.settings = QSettings('upide', 'settings')
+      self.watcher = None
+      self.capture = None
       
       self.initUI()
       app.aboutToQuit.connect(self.on_exit)
@@ -44,6 +51,7 @@ class Window(QMainWindow):
 
    def on_exit(self):
       self.board.close()
+      if self.capture: self.capture.close()
 
    def closeEvent(self, event):
       if self.editors.isModified():      
@@ -80,7 +88,9 @@ class Window(QMainWindow):
       # UI that might interfere with this
 
       # clear console on command start
-      if busy: self.console.clear()
+      if busy:
+         self.console.clear()
+         if self.plotter: self.plotter.clear()
       
       # disable all run buttons during busy. Enable all of them
       # afterwards. One may become a stop button in the meantime.
@@ -174,7 +184,21 @@ class Window(QMainWindow):
       self.status(self.tr("Running code ..."));
       self.on_board_request(True)
       self.console.set_button(None)
-      self.board.cmd(Board.RUN, self.on_run_done, { "name": name, "code": code } )
+      self.board.cmd(Board.RUN, self.on_run_done, { "name": name, "code": self.compiled(code) } )
+
+   def compiled(self, code):
+      # run code precompiled if enabled. It's then imported as a module,
+      # so scripts using __name__, e.g. to check for "__main__", are run
+      # from source. So are scripts with syntax errors to get the error
+      # from the device
+      if not self.compile or mpycross.uses_name(code): return code
+      try:
+         mpy = self.compiler.compile(code, "<stdin>")
+      except (OSError, ValueError):
+         return code
+      if mpy is None: return code
+
+      return mpycross.loader(mpy)
 
    def on_stop_timeout(self):
       # the stop command has run into a timeout. Force the board communication
@@ -230,9 +254,9 @@ class Window(QMainWindow):
 
    def backup_done(self, ok, msg = ""):
       # TODO: ask user to keep the remaining files
-      if len(self.zip_old):
+      if self.backup.removed:
          print("ZIP remains:")
-         for f in self.zip_old:
+         for f in self.backup.removed:
             print("  ", f)
             
       if ok: self.status(self.tr("Backup successful"))
@@ -240,89 +264,26 @@ class Window(QMainWindow):
       # re-enable UI     
       self.on_board_request(False)
       self.console.set_button(True)
+      self.backup = None
 
-      if self.zip:
-         self.zip.close()
-         self.zip = None
+   def on_backup_message(self, status, msg):
+      self.status(status)
+      self.console.appendFinal(msg + "\n", None)
 
-   def on_backup_file(self, success, ctx):
+   def on_backup_listdir(self, success, result=None):
+      self.listed(success, result)
       if not success:
-         # backup failed
-         self.backup_done(False, "Board com failed")
-         return
-
-      try:
-         # write file to zip, but without leading slash
-         name = ctx["name"]
-         if name.startswith("/"):
-            name = name[1:]
-         
-            # if we got a fresh file, then forget about the old one
-            # from the zip
-            try:
-               self.zip_old.pop(name)
-            except:
-               pass
-               
-         with self.zip.open(name, mode='w') as f:
-            f.write(ctx["code"])
-            f.close()
-      except Exception as e:
-         self.backup_done(False, str(e))
-         return
-            
-      # backup next file
-      self.backup_next_file(ctx["name"])
-
-   def backup_file(self, f):
-      if not f:
-         # no more file to backup
-         self.backup_done(True)
-         return
-
-      # get file node
-      node = self.fileview.findNode(f)
-      if not node:
-         # problem getting file node
-         print("ERROR getting node for", f)
-         self.backup_done(False, "No node")
+         self.backup.finish(False, "Listing failed")
          return
-         
-      self.status(self.tr("Backing up {}").format(f.split("/")[-1]))
-      self.console.appendFinal(self.tr("Backing up {}").format(f) + "\n", None)
-      self.board.cmd(Board.GET_FILE, self.on_backup_file, { "name": f, "size": node.size } )
 
-   def backup_get_old_hash(self, f):
-      if f.lstrip("/") in self.zip_old:      
-         return hashlib.sha1(self.zip_old[f.lstrip("/")]).digest()
+      # collect all files and their sizes
+      files = [ ]
+      f = self.fileview.get_next_file()
+      while f != None:
+         files.append( ( f, self.fileview.get_file_size(f) ) )
+         f = self.fileview.get_next_file(f)
 
-      return None
-      
-   def backup_next_file(self, cur=None):
-      f = self.fileview.get_next_file(cur)
-
-      # check if we work on an existing backup
-      if hasattr(self, "hashes") and self.hashes:      
-         while f != None and self.backup_get_old_hash(f) == self.hashes[f]:
-            self.status(self.tr("Unmodified {}").format(f.split("/")[-1]))
-            self.console.appendFinal(self.tr("Unmodified {}").format(f) + "\n", None)
-      
-            # save existing from old zip
-            name = f.lstrip("/")
-            with self.zip.open(name, mode='w') as zf:
-               zf.write(self.zip_old[name])
-               zf.close()
-               self.zip_old.pop(name)
-
-            f = self.fileview.get_next_file(f)
-
-      self.backup_file(f)
-      
-   def on_backup_hash(self, success, hashes=None):
-      self.hashes = hashes
-
-      # start backup with first file
-      self.backup_next_file()
+      self.backup.start(files)
          
       # user wants to make a full backup
    def on_backup(self):            
@@ -336,43 +297,16 @@ class Window(QMainWindow):
          self.on_board_request(True)
          self.console.set_button(None)
 
-         try:
-            # try to open zip and retrieve it's contents to allow
-            # for SHA1 comparison and omit downloading existing files
-            self.zip_old = {}
-            try:
-               zip = zipfile.ZipFile(fname, 'r')
-               files = zip.namelist()
-
-               # read all files into memory
-               for file in files:
-                  with zip.open(file, 'r') as f:
-                     self.zip_old[file] = f.read()
-                     f.close()
-            
-               zip.close()
-
-               # open new zip for writing, overwriting the old one
-               self.zip = zipfile.ZipFile(fname, 'w')
-            
-               # get all hashes from device to check which files are
-               # unmodified in the existing backup
-               self.status(self.tr("Preparing backup"))
-               self.board.cmd(Board.HASH, self.on_backup_hash, self.fileview.number_of_files())
-               return
+         # files are streamed into the archive, unmodified files
+         # are taken over from an existing archive
+         self.backup = Backup(self.board, fname, self)
+         self.backup.message.connect(self.on_backup_message)
+         self.backup.done.connect(self.backup_done)
          
-            except:
-               pass
-
-            self.zip = zipfile.ZipFile(fname, 'w')
-         except Exception as e:
-            self.backup_done(False, str(e))
-            return
-
-         # start backup with first file
-         self.hashes = None  # no old backup, so no need for hashes
-         f = self.fileview.get_next_file()
-         self.backup_file(f)
+         # the file view may only know some directories yet. So
+         # list all files before starting the backup
+         self.status(self.tr("Preparing backup"))
+         self.listdir(self.on_backup_listdir, True)
 
    def eventFilter(self, obj, event):
       if event.type() == QEvent.MouseButtonRelease:
@@ -390,9 +324,9 @@ class Window(QMainWindow):
       if ok: self.status(self.tr("Restoration successful"))
       else:  self.status(self.tr("Restoration failed"))
 
-      if self.zip:
-         self.zip.close()
-         self.zip = None
+      # files on the device which were not part of the backup
+      self.restore_files_before = self.restore.remaining if self.restore else [ ]
+      self.restore = None
 
       if len(self.restore_files_before) > 0:
          # there are files on the device which were not from the backup. Ask user
@@ -430,7 +364,7 @@ class Window(QMainWindow):
                if self.cbox.itemData(i, Qt.CheckStateRole) == Qt.Checked:
                   self.status(self.tr("Deleting: {}").format(f.split("/")[-1])) 
                   self.console.appendFinal(self.tr("Deleting: {}").format(f) + "\n", None)
-                  self.board.rm(f)
+                  self.board.cmd(Board.RM, self.on_fs_done, { "name": f })
 
                   # close the editor if it existed
                   self.editors.close("/"+f)
@@ -440,49 +374,24 @@ class Window(QMainWindow):
                
       # once done reload the entire fileview. This will also
       # re-enable the ui and reload open files
-      self.board.cmd(Board.LISTDIR, self.on_listdir)
-
-   def on_refresh(self):
-      self.on_board_request(True)
-      self.board.cmd(Board.LISTDIR, self.on_refresh_listdir)
-      
-   def restore_get_next_file(self, f = None):
-      files = self.zip.namelist()
-      if not f:
-         # no filename give -> restore first file
-         idx = -1
-      else:
-         idx = files.index(f)
-         if idx < 0: return None
-
-      while idx+1 < len(files):
-         # don't explicitely restore directories. They
-         # are implicitely restored via the file names. This
-         # should actually never happen with the backup
-         # files as they don't explicitely store directories at all
-         fname = files[idx+1]
-         if not fname.endswith("/"):
-            return fname
-
-         idx = idx + 1
-         
-      return None
-         
-   def mkdir(self, name):
-      try:
-         self.board.mkdir(name)
-      except Exception as e:
-         return False
-
-      return True
+      self.listdir(self.on_listdir)
 
-   def on_restore_file(self, success, parms):
-      if not success:
-         self.restore_done(False)
+   def on_refresh(self, path):
+      if path:
+         # only a single directory is to be refreshed
+         self.fileview.invalidate(path)
          return
+      
+      self.on_board_request(True)
+      self.listdir(self.on_refresh_listdir)
 
-      self.restore_next_file(self.restore_file_name)
+   def on_fetch(self, path):
+      # the file view needs the contents of a directory
+      self.board.cmd(Board.LISTDIR, self.on_fetched, { "path": path, "recursive": False })
 
+   def on_fetched(self, success, result=None):
+      self.listed(success, result)
+      
    def mkpath(self, path):
       # treat all paths as absolute
       if path.startswith("/"):
@@ -495,40 +404,13 @@ class Window(QMainWindow):
          for i in range(len(path_parts)):
             check_path = "/" + "/".join(path_parts[:i+1])
             if not self.fileview.exists(check_path):
-               if self.mkdir(check_path):
-                  self.fileview.add_dir_entry(check_path)
-               else:
-                  return False
+               # commands are processed in order, so the directory
+               # exists once the file is written
+               self.board.cmd(Board.MKDIR, self.on_fs_done, { "name": check_path })
+               self.fileview.add_dir_entry(check_path)
                
       return True      
       
-   def restore_file(self, f):
-      self.status(self.tr("Restoring {}").format(f.split("/")[-1]))
-      self.console.appendFinal(self.tr("Restoring {}").format(f) + "\n", None)
-
-      # check if this file is in list of previous installed files (file was
-      # already there) and remove it from that list
-      if f in self.restore_files_before:
-         self.restore_files_before.remove(f)
-   
-      if not self.mkpath(f):
-         # failed to create directory. Abort restore
-         self.restore_done(False)
-         return
-      
-      # full path should now exist, so restore file      
-      try:
-         with self.zip.open(f, 'r') as infile:
-            data = infile.read()
-            infile.close()
-            self.restore_file_name = f
-            self.editors.update("/"+f, data)
-            self.board.cmd(Board.PUT_FILE, self.on_restore_file, { "name": f, "code": data } )
-      except Exception as e:
-         print("restore exception", str(e))
-         self.restore_done(False)
-         return
-
       # user wants to import a file from PC
    def on_file_import(self, dir_name):
       fname = QFileDialog.getOpenFileName(self, self.tr('Import file'),'.',self.tr("Any file (*)"))[0]
@@ -570,46 +452,22 @@ class Window(QMainWindow):
          self.console.set_button(None)
          self.board.cmd(Board.GET_FILE, self.on_export_file, { "name": name, "size": size, "fname": fname } )
 
-   def restore_next_file(self, name=None):
-      f = self.restore_get_next_file(name)
-      skipped = True
-
-      while f != None and skipped:
-         # check if file really needs to be restored or if hash still matches
-         if hasattr(self, "hashes") and self.hashes:
-            # read file from zip to verify hash
-            try:
-               with self.zip.open(f, 'r') as infile:
-                  hash = hashlib.sha1(infile.read()).digest()
-                  infile.close()
-            except:
-               hash = None
-
-            # file is still identical, so don't restore
-            if ("/"+f) in self.hashes and hash == self.hashes["/"+f]:
-               self.status(self.tr("Unmodified {}").format(f.split("/")[-1]))
-               self.console.appendFinal(self.tr("Unmodified {}").format(f) + "\n", None)
-
-               # check if this file is in list of previous installed files (file was
-               # already there) and remove it from that list
-               if f in self.restore_files_before:
-                  self.restore_files_before.remove(f)
-
-               f = self.restore_get_next_file(f)
-            else:
-               # file is not already there and thus cannot be skipped
-               skipped = False
-                  
-      if f == None:
-         # no more file to restore
-         self.restore_done(True)
-         return
+   def on_restore_message(self, status, msg):
+      self.status(status)
+      self.console.appendFinal(msg + "\n", None)
+
+   def on_restored(self, name, data):
+      # update an open editor with the restored contents
+      self.editors.update(name, data)
       
-      self.restore_file(f)
+   def on_restore_listdir(self, success, result=None):
+      self.listed(success, result)
+      if not success:
+         self.restore.finish(False)
+         return
       
-   def on_restore_hash(self, success, hashes=None):
-      self.hashes = hashes
-      self.restore_next_file()
+      # pass the list of currently installed files
+      self.restore.start(self.fileview.getFileList())
 
       # user wants to restore a full backup
    def on_restore(self):            
@@ -619,23 +477,163 @@ class Window(QMainWindow):
          if not fname.lower().endswith(".zip"):
             fname = fname + ".zip"
 
-         # save list of currently installed files
-         self.restore_files_before = self.fileview.getFileList()
-         
          # disable gui during restore
          self.on_board_request(True)
          self.console.set_button(None)
 
+         # files are only written if they differ from the ones on
+         # the board. The engine plans everything up front
          try:
-            self.zip = zipfile.ZipFile(fname, 'r')
+            self.restore = Restore(self.board, fname, self)
          except Exception as e:
+            self.restore = None
             self.restore_done(False)
             return
+         
+         self.restore.message.connect(self.on_restore_message)
+         self.restore.restored.connect(self.on_restored)
+         self.restore.done.connect(self.restore_done)
 
-         self.hashes = None
+         # the file view may only know some directories yet. So
+         # list all files before starting the restoration
          self.status(self.tr("Preparing restoration"))
-         self.board.cmd(Board.HASH, self.on_restore_hash, len(self.restore_files_before))
+         self.listdir(self.on_restore_listdir, True)
             
+   def sync_done(self, ok):
+      if ok: self.status(self.tr("Sync successful"))
+      else:  self.status(self.tr("Sync failed"))
+      self.sync = None
+
+      # files may have been created and removed on the board. Reloading
+      # the file view also re-enables the ui
+      self.listdir(self.on_listdir)
+
+   def on_sync_message(self, status, msg):
+      self.status(status)
+      self.console.appendFinal(msg + "\n", None)
+
+   def on_sync_listdir(self, success, result=None):
+      self.listed(success, result)
+      if not success:
+         self.sync.finish(False)
+         return
+
+      files = [ ]
+      f = self.fileview.get_next_file()
+      while f != None:
+         files.append( ( f, self.fileview.get_file_size(f) ) )
+         f = self.fileview.get_next_file(f)
+
+      self.sync.start(files)
+
+      # user wants to sync a local folder with the board
+   def on_sync(self):
+      folder = QFileDialog.getExistingDirectory(self, self.tr('Sync folder'),
+                                                self.settings.value('sync_folder', '.'))
+      if folder:
+         self.settings.setValue('sync_folder', folder)
+
+         # disable gui during sync
+         self.on_board_request(True)
+         self.console.set_button(None)
+
+         self.sync = Sync(self.board, folder, self)
+         self.sync.message.connect(self.on_sync_message)
+         self.sync.uploaded.connect(self.on_restored)
+         self.sync.done.connect(self.sync_done)
+
+         # the sizes of all files are needed to download them
+         self.status(self.tr("Preparing sync"))
+         self.listdir(self.on_sync_listdir, True)
+
+   def on_watch_removed(self, names):
+      for name in names:
+         self.fileview.remove(name)
+
+   def on_watch_uploaded(self, name, data):
+      # make the uploaded file show up in the file view
+      parts = name.split("/")[1:-1]
+      for i in range(len(parts)):
+         path = "/" + "/".join(parts[:i+1])
+         if not self.fileview.exists(path):
+            self.fileview.add_dir_entry(path)
+      if self.fileview.exists(name): self.fileview.saved(name, len(data))
+      else:                          self.fileview.add_file_entry(name, len(data))
+      self.editors.update(name, data)
+
+      # user wants local files to be uploaded whenever they change
+   def on_watch(self, enabled):
+      if self.watcher:
+         self.watcher.stop()
+         self.watcher = None
+
+      if enabled:
+         folder = QFileDialog.getExistingDirectory(self, self.tr('Auto upload folder'),
+                                                   self.settings.value('sync_folder', '.'))
+         if not folder:
+            self.fileview.watchAction.setChecked(False)
+            return
+
+         self.settings.setValue('sync_folder', folder)
+         self.watcher = Watcher(self.board, folder, self.compiler if self.compile else None, self)
+         self.watcher.message.connect(self.on_sync_message)
+         self.watcher.uploaded.connect(self.on_watch_uploaded)
+         self.watcher.removed.connect(self.on_watch_removed)
+         self.status(self.tr("Watching {}").format(folder))
+
+      # user wants python files to be compiled before being run or uploaded
+   def on_compile(self, enabled):
+      self.compile = enabled
+      self.settings.setValue('compile', enabled)
+      if self.watcher: self.watcher.compiler = self.compiler if enabled else None
+      if enabled and not self.compiler.binary:
+         self.status(self.tr("mpy-cross not found, files are used as source"))
+
+      # user wants the console output to be recorded
+   def on_capture(self, enabled):
+      if self.capture:
+         self.board.set_capture(None)
+         self.capture.close()
+         if self.capture.error: self.status(self.tr("Capture failed: ") + self.capture.error)
+         self.capture = None
+      self.console.capturing = False
+
+      if enabled:
+         fname = QFileDialog.getSaveFileName(self, self.tr('Capture console'),'.',self.tr("Console capture (*.cap)"))[0]
+         if not fname: return
+         try:
+            self.capture = Capture(fname)
+         except OSError as e:
+            self.status(self.tr("Capture failed: ") + str(e))
+            return
+         self.board.set_capture(self.capture)
+         self.console.capturing = True
+         self.status(self.tr("Capturing to {}").format(os.path.basename(fname)))
+
+      # show the end of a captured console session
+   def on_replay(self):
+      fname = QFileDialog.getOpenFileName(self, self.tr('Replay capture'),'.',self.tr("Console capture (*.cap *.cap.*)"))[0]
+      if fname:
+         try:
+            reader = CaptureReader(fname)
+            data = reader.tail(4*1024*1024)
+            reader.close()
+         except (OSError, ValueError) as e:
+            self.status(self.tr("Replay failed: ") + str(e))
+            return
+         self.console.clear()
+         self.console.appendBytes(data)
+
+      # user wants numeric console output to be plotted
+   def on_plot(self, enabled):
+      if not self.plotter:
+         self.status(self.tr("Plotting requires numpy"))
+         return
+
+      self.console.plotting = enabled
+      self.plotter.setVisible(enabled)
+      self.plotter.clear()
+
    def show_exception(self, e):
       # this was an exception forwarded from the target 
       if len(e.args) == 3 and e.args[0] == "exception":
@@ -645,18 +643,16 @@ class Window(QMainWindow):
          
       # user wants to create a new directory
    def on_mkdir(self, name):
-      try:
-         self.board.mkdir(name)
-      except Exception as e:
-         self.show_exception(e)
+      self.board.cmd(Board.MKDIR, self.on_fs_done, { "name": name })
 
    def on_delete(self, name):
       # close tab if present
       self.editors.close(name)
-      try:
-         self.board.rm(name)
-      except Exception as e:
-         self.show_exception(e)
+      self.board.cmd(Board.RM, self.on_fs_done, { "name": name })
+
+   def on_fs_done(self, success, parms=None):
+      # other failures have already been reported by the board
+      if not success and parms: self.show_exception(parms["error"])
          
    def on_example_saved(self, ctx = None):
       # the example has been saved. next check if there are additional
@@ -688,6 +684,18 @@ class Window(QMainWindow):
          with open(local, "rb") as f:
             code = f.read()
 
+            # python files are imported as .mpy if enabled. Not if a source
+            # of that name exists on the board as it would be imported instead
+            if self.compile and name.endswith(".py") and not self.fileview.exists(name) and \
+               not name.split("/")[-1] in Watcher.SOURCE_ONLY:
+               try:
+                  mpy = self.compiler.compile(code, name)
+               except ValueError as e:
+                  self.on_message(self.tr("Compiling failed:") + "\n\n" + str(e))
+                  return
+               if mpy is not None:
+                  name, code = name[:-3] + ".mpy", mpy
+
             # check if this file already exists
             # check if fileview thinks this is something that can
             # be opened in an editor. Set no_edit flag if not
@@ -697,19 +705,23 @@ class Window(QMainWindow):
          self.on_message(self.tr("Import failed:") + "\n\n" + str(e))
       
    def on_rename(self, old, new):
-      try:
-         self.board.rename(old, new)
-         self.editors.rename(old, new)
-      except Exception as e:
-         self.show_exception(e)
+      self.board.cmd(Board.RENAME, self.on_renamed, { "name": old, "new": new })
 
-         # if the rename failed then the internal file tree may now be
-         # out of sync, so we reload it
-         self.select_file = old
-         self.board.cmd(Board.LISTDIR, self.on_rename_listdir)
+   def on_renamed(self, success, parms=None):
+      if success:
+         self.editors.rename(parms["name"], parms["new"])
+         return
+
+      # other failures have already been reported by the board
+      if parms: self.show_exception(parms["error"])
+
+      # if the rename failed then the internal file tree may now be
+      # out of sync, so we reload it
+      self.select_file = parms["name"] if parms else ""
+      self.listdir(self.on_rename_listdir)
 
-   def on_rename_listdir(self, success, files=None):
-      self.on_listdir(success, files)
+   def on_rename_listdir(self, success, result=None):
+      self.on_listdir(success, result)
       # make source file visible again
       self.fileview.select(self.select_file)
       
@@ -755,6 +767,7 @@ class Window(QMainWindow):
       self.fileview.rename.connect(self.on_rename)
       self.fileview.message.connect(self.on_message)
       self.fileview.refresh.connect(self.on_refresh)
+      self.fileview.fetch.connect(self.on_fetch)
       self.fileview.firmware.connect(self.on_firmware)
       self.fileview.host_import.connect(self.on_import)
       self.fileview.example_import.connect(self.on_example)
@@ -762,6 +775,9 @@ class Window(QMainWindow):
       self.fileview.example_file_imported.connect(self.on_example_file_imported)
       self.fileview.backup.connect(self.on_backup)
       self.fileview.restore.connect(self.on_restore)
+      self.fileview.sync.connect(self.on_sync)
+      self.fileview.watch.connect(self.on_watch)
+      self.fileview.compile.connect(self.on_compile)
       self.fileview.file_import.connect(self.on_file_import)
       self.fileview.file_export.connect(self.on_file_export)
       self.hsplitter.addWidget(self.fileview)
@@ -784,8 +800,21 @@ class Window(QMainWindow):
       # the console is at the bottom
       self.console = Console()
       self.console.interact.connect(self.on_console_interact)
+      self.console.capture.connect(self.on_capture)
+      self.console.replay.connect(self.on_replay)
+      self.console.plot.connect(self.on_plot)
+      # the console only keeps the most recent output
+      self.console.set_max_lines(self.settings.value('console_lines', Console.MAX_LINES, type=int))
       
-      self.vsplitter.addWidget(self.console)
+      # the optional plotter is shown next to it
+      self.csplitter = QSplitter(Qt.Horizontal)
+      self.csplitter.addWidget(self.console)
+      self.plotter = Plotter() if Plotter.available() else None
+      if self.plotter:
+         self.plotter.hide()
+         self.csplitter.addWidget(self.plotter)
+
+      self.vsplitter.addWidget(self.csplitter)
       self.vsplitter.setStretchFactor(1, 1)
 
       return self.vsplitter
@@ -848,25 +877,38 @@ class Window(QMainWindow):
          self.editors.on_select(self.settings.value('editor_current'))
          return
             
-      # try to open first file in list
+      # try to open first file in list. The size of files in directories
+      # that haven't been listed yet is unknown
       size = self.fileview.get_file_size(filelist[0])
       if size == None:
-         self.on_all_loaded()
-         return
+         if self.fileview.is_listed(filelist[0].rsplit("/", 1)[0]):
+            self.on_all_loaded()
+            return
+         size = 0
 
       self.board.cmd(Board.GET_FILE, self.on_loaded, { "name": filelist[0],
                    "size": size, "filelist": filelist[1:], "quiet": True } )
          
-   def on_refresh_listdir(self, success, files=None):
-      if success:
-         self.fileview.set(files)
-
+   def listdir(self, cb, recursive = False):
+      # the file view is cleared and then filled by the board's entries
+      # signal while the listing is still running. Unless recursive only
+      # the root directory is listed, subdirectories are fetched on demand
+      self.fileview.set([ ])
+      self.fileview.listing("")
+      self.board.cmd(Board.LISTDIR, cb, { "path": "", "recursive": recursive })
+
+   def listed(self, success, result):
+      # a listing has completed, let the file view know
+      if success: self.fileview.listed(result["path"], result["recursive"])
+      else:       self.fileview.listing_failed()
+      
+   def on_refresh_listdir(self, success, result=None):
+      self.listed(success, result)
       self.on_board_request(False)
          
-   def on_listdir(self, success, files=None):
+   def on_listdir(self, success, result=None):
+      self.listed(success, result)
       if success:
-         self.fileview.set(files)
-         
          # try to restore all previously open files
          self.open_next_file(self.settings.value('editor_open'))
       
@@ -882,13 +924,14 @@ class Window(QMainWindow):
       self.status(self.tr("{0} connected, MicroPython V{1} on {2}").format(self.board.getPort(), version['release'], version['nodename']));
       self.fileview.sysname(version['nodename'])
       self.sysname = version['nodename']
+      self.compiler.set_target(version.get('mpy', 0))
       self.on_board_request(False)
       self.console.set_button(True)
 
       # version received, request files
       self.on_board_request(True)
       self.console.set_button(None)
-      self.board.cmd(Board.LISTDIR, self.on_listdir)
+      self.listdir(self.on_listdir)
 
    def on_retry_dialog_button(self, btn):
       if btn.text() == self.tr("Flash..."):
@@ -946,6 +989,7 @@ class Window(QMainWindow):
          
    def on_console(self, a):
       self.console.appendBytes(a)
+      if self.console.plotting: self.plotter.feed(a)
       
    def on_error(self, name, msg):
       # assume the error message is an exception and try to parse
@@ -1013,6 +1057,9 @@ class Window(QMainWindow):
          # unable to parse error. Just display the entire message
          self.console.append("\n".join(lines), color="red")
 
+   def on_latency(self, name, ms):
+      self.latencyLabel.setText("{0}: {1:.0f} ms".format(name, ms))
+      
    def progress(self, val=False):
       # val can be False, None/<0 or 0..100
       if val is False:
@@ -1127,6 +1174,11 @@ class Window(QMainWindow):
       self.progressBar.setFixedHeight(16)
       self.progress(False)
       self.statusBar().addPermanentWidget(self.progressBar);
+
+      # show how long the last board operation took
+      self.latencyLabel = QLabel()
+      self.latencyLabel.setToolTip(self.tr("Duration of the last board operation"))
+      self.statusBar().addPermanentWidget(self.latencyLabel);
       
       self.setCentralWidget(self.mainWidget())
       self.resize(640,480)
@@ -1142,6 +1194,34 @@ class Window(QMainWindow):
       self.board.lost.connect(self.port_lost)
       self.board.interactive.connect(self.on_interactive)
       self.board.code_downloaded.connect(self.on_code_downloaded)
+      self.board.latency.connect(self.on_latency)
+      self.board.entries.connect(self.fileview.add_entries)
+
+      # helper functions can be kept on the device ("ram" or "flash") or be
+      # sent with each command ("off")
+      self.board.set_helper_mode(self.settings.value('helper_mode', "ram"))
+
+      # the digests of all files can be cached in a manifest on the device
+      # to speed up backup and restore. This adds a file to the device and
+      # is thus off by default
+      self.board.set_hash_cache(self.settings.value('hash_cache', False, type=bool))
+
+      # files may be sent compressed if the device supports it. This
+      # needs space for a temporary file on the device and is thus off
+      # by default
+      self.board.set_compress(self.settings.value('compress', False, type=bool))
+
+      # the code run last may be kept on the device, so it doesn't have to
+      # be sent again when it's run again unchanged. This writes to the
+      # device's flash and is thus off by default
+      self.board.set_run_cache(self.settings.value('run_cache', False, type=bool))
+
+      # python files may be compiled with mpy-cross before being run or
+      # uploaded. The results are cached
+      self.compile = self.settings.value('compile', False, type=bool)
+      self.compiler = MpyCross(os.path.join(QStandardPaths.writableLocation(QStandardPaths.CacheLocation), "mpy"),
+                               self.settings.value('mpy_cross', None))
+      self.fileview.compileAction.setChecked(self.compile)
 
       # start scanning for board
       self.progress(False)
@@ -0,0 +1,81 @@
+#
+# test_buffered_serial.py
+#
+# regression tests for the receive ring buffer of buffered_serial
+#
+# Copyright (C) 2021 Till Harbaum <till@harbaum.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51 Franklin
+# Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# The device side is emulated by the master side of a pty. Works on Linux
+# and macOS only.
+
+import os, sys, random, time, tty, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import buffered_serial
+
+class SmallSerial(buffered_serial.Serial):
+    # a tiny ring makes the data wrap after a few bytes
+    BUFFER_SIZE = 16
+
+@unittest.skipUnless(hasattr(os, "openpty"), "needs a pty")
+class TestFind(unittest.TestCase):
+    def setUp(self):
+        self.master, slave = os.openpty()
+        tty.setraw(self.master)
+        self.serial = SmallSerial(os.ttyname(slave), timeout=1)
+        os.close(slave)
+
+    def tearDown(self):
+        self.serial.close()
+        os.close(self.master)
+
+    def feed(self, data):
+        # write to the device side and wait until it has been buffered
+        os.write(self.master, data)
+        expected = self.serial._used + len(data)
+        deadline = time.monotonic() + 1
+        while self.serial._used < expected and time.monotonic() < deadline:
+            self.serial._fill()
+        self.assertEqual(self.serial._used, expected)
+
+    def wrap(self, stream, head):
+        # store stream in the empty ring starting at offset head
+        self.assertEqual(self.serial._used, 0)
+        self.serial._head = head
+        self.feed(stream)
+
+    def test_ending_across_wrap(self):
+        # only two bytes wrapped into the lower part while the ending
+        # needs five bytes from the upper part
+        stream = b"b\ra\n\na\n\r\nab\n"
+        self.wrap(stream, 6)
+        self.assertGreater(self.serial._head + self.serial._used, len(self.serial._buffer))
+        self.assertEqual(self.serial.find(b"\n\r\nab"), 6)
+        self.assertEqual(self.serial.read(len(stream)), stream)
+
+    def test_random(self):
+        # compare against bytes.find for all possible layouts of the ring
+        rnd = random.Random(0)
+        for i in range(2000):
+            stream = bytes(rnd.choice(b"ab\r\n") for _ in range(rnd.randint(1, 16)))
+            ending = bytes(rnd.choice(b"ab\r\n") for _ in range(rnd.randint(1, 5)))
+            start = rnd.randint(0, len(stream))
+            self.wrap(stream, rnd.randint(0, 15))
+            self.assertEqual(self.serial.find(ending, start), stream.find(ending, start),
+                             (stream, ending, start, self.serial._head))
+            self.serial.read(len(stream))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+#
+# bench_read_until.py
+#
+# measure the throughput of Pyboard.read_until against a loopback pty
+#
+# Copyright (C) 2021 Till Harbaum <till@harbaum.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51 Franklin
+# Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Usage: python3 tools/bench_read_until.py [size_in_kb]
+#
+# The device side is emulated by a thread writing to the master side of a
+# pty at the rate the given baudrate would allow (10 bits per byte). A
+# baudrate of 0 writes as fast as possible. Works on Linux and macOS only.
+
+import os, sys, time, threading, tty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import pyboard
+
+class Unbuffered:
+    # hides the buffered serial extensions so read_until falls back
+    # to the byte-by-byte loop
+    def __init__(self, serial):
+        self.serial = serial
+
+    def read(self, num):
+        return self.serial.read(num)
+
+    def inWaiting(self):
+        return self.serial.inWaiting()
+
+def writer(fd, data, baudrate):
+    chunk = 256
+    start = time.monotonic()
+    for i in range(0, len(data), chunk):
+        if baudrate:
+            # pace the data as a real uart would
+            delay = start + i * 10 / baudrate - time.monotonic()
+            if delay > 0: time.sleep(delay)
+        os.write(fd, data[i:i+chunk])
+
+def run(board, master, size, baudrate, ending, consumer):
+    # payload does not contain the ending, mimic regular console output
+    payload = (b"0123456789abcdef" * 4 + b"\r\n") * (size // 66 + 1)
+    data = payload[:size] + ending
+
+    received = [ 0 ]
+    def count(d): received[0] += len(d)
+
+    thread = threading.Thread(target=writer, args=(master, data, baudrate))
+    start = time.monotonic()
+    cpu = time.process_time()
+    thread.start()
+    ret = board.read_until(1, ending, timeout=5, data_consumer=count if consumer else None)
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu
+    thread.join()
+
+    if not consumer: received[0] = len(ret)
+    assert received[0] == len(data), "received {} of {} bytes".format(received[0], len(data))
+    return len(data) / elapsed / 1024, cpu
+
+def main():
+    size = int(sys.argv[1]) * 1024 if len(sys.argv) > 1 else 256 * 1024
+
+    master, slave = os.openpty()
+    tty.setraw(master)
+    board = pyboard.Pyboard(os.ttyname(slave))
+    board.serial.timeout = 1
+    buffered = board.serial
+
+    print("{} KB per run".format(size // 1024))
+    print("{:>8} {:>10} {:>10} {:>12} {:>10}".format("baud", "mode", "ending", "KB/s", "cpu s"))
+    for baudrate in [ 115200, 921600, 2000000, 0 ]:
+        for mode in [ "legacy", "buffered" ]:
+            board.serial = Unbuffered(buffered) if mode == "legacy" else buffered
+            for ending, consumer in [ (b"\x04", True), (b"raw REPL; CTRL-B to exit\r\n>", False) ]:
+                rate, cpu = run(board, master, size, baudrate, ending, consumer)
+                print("{:>8} {:>10} {:>10} {:>12.1f} {:>10.3f}".format(
+                   baudrate if baudrate else "max", mode, "1 byte" if len(ending) == 1 else "prompt", rate, cpu))
+
+    board.serial = buffered
+    board.close()
+    os.close(master)
+
+if __name__ == "__main__":
+    main()